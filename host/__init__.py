@@ -0,0 +1 @@
+"""Host-side tooling for RSI: hardware abstraction layer and simulator for running main.py under CPython."""
@@ -0,0 +1,444 @@
+"""Host-side hardware abstraction layer for running main.py under CPython.
+
+install(board) registers fake MicroPython modules (machine, network, esp32, ntptime, urequests, utime, uasyncio,
+ujson, uos, deflate, gc) in sys.modules, all of them backed by a single Board instance and its VirtualClock.
+"""
+import asyncio
+import calendar
+import gc as _gc
+import json
+import os
+import selectors
+import sys
+import time as _time
+import tracemalloc
+import types
+import zlib
+
+EPOCH_2000: int = 946684800  # MicroPython's utime.time() counts from 2000-01-01
+TICKS_PERIOD: int = 1 << 30
+
+
+class VirtualClock:
+    """Seconds since 2000-01-01. When accelerated, time only moves when advance() is called."""
+
+    def __init__(self, start: float = 0, accelerated: bool = True):
+        self.accelerated = accelerated
+        self._start = start or (_time.time() - EPOCH_2000)
+        self._elapsed = 0.0
+        self._t0 = _time.monotonic()
+
+    def monotonic(self) -> float:
+        if self.accelerated:
+            return self._elapsed
+        return self._elapsed + _time.monotonic() - self._t0
+
+    def time(self) -> float:
+        return self._start + self.monotonic()
+
+    def set_time(self, timestamp: float) -> None:
+        self._start = timestamp - self.monotonic()
+
+    def advance(self, seconds: float) -> None:
+        if seconds <= 0:
+            return
+        if self.accelerated:
+            self._elapsed += seconds
+        else:
+            _time.sleep(seconds)
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    """Jumps the clock forward instead of waiting when no I/O is ready."""
+
+    def __init__(self, clock: VirtualClock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        if not self.clock.accelerated:
+            return super().select(timeout)
+        events = super().select(0)
+        if not events:
+            if timeout is None:
+                return super().select(None)
+            self.clock.advance(timeout)
+        return events
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock: VirtualClock):
+        super().__init__(VirtualSelector(clock))
+        self.clock = clock
+
+    def time(self) -> float:
+        return self.clock.monotonic()
+
+
+class Board:
+    """State of the simulated board: pin levels, ADC inputs, WiFi and an event log of pin writes."""
+
+    def __init__(self, clock: VirtualClock = None, machine_name: str = 'Host simulator with S2_MINI'):
+        self.clock = clock or VirtualClock()
+        self.machine_name = machine_name
+        self.pins = {}          # pin_id -> (mode, value)
+        self.pin_log = []       # (clock.time(), pin_id, mode, value)
+        self.adc = {}           # pin_id -> callable(clock.time()) -> raw u16
+        self.mcu_temperature = 40
+        self.cpu_freq = 240_000_000
+        self.mac = b'\x7c\xdf\xa1\x12\x34\x56'
+        self.wifi_available = True
+        self.wifi_connected = False
+        self.wifi_connect_sec = 0.0     # how long WLAN.connect() takes to associate
+        self.wifi_connected_at = 0.0
+        self.ntp_available = True
+        self.http_get = None    # callable(url, timeout) -> (status_code, text), None means network down
+        self.http_log = []      # (clock.time(), url)
+        self.heap_size = 2_000_000
+        self.rtc_memory = b''   # machine.RTC().memory(), survives resets but not a power loss
+        self.wake_on_ext0 = None    # (pin_id, level) set by esp32.wake_on_ext0()
+        self.button_presses = []    # clock.monotonic() of presses that wake a light sleep up
+        self.wake_reason = 0
+        self.sleep_log = []     # (clock.monotonic(), slept seconds, wake reason) per machine.lightsleep()
+
+    def set_pin(self, pin_id: int, mode: int, value: int) -> None:
+        self.pins[pin_id] = (mode, value)
+        self.pin_log.append((self.clock.time(), pin_id, mode, value))
+
+    def read_adc(self, pin_id: int) -> int:
+        source = self.adc.get(pin_id)
+        return int(source(self.clock.time())) if source else 0
+
+
+_board: Board = None
+
+
+# machine
+class Pin:
+    IN = 1
+    OUT = 3
+    OPEN_DRAIN = 7
+    PULL_UP = 2
+    PULL_DOWN = 1
+
+    def __init__(self, pin_id, mode=-1, pull=-1, *, value=None):
+        self.id = pin_id
+        # like MicroPython, Pin(pin_id) without arguments doesn't reconfigure the pin
+        if mode != -1 or pull != -1 or value is not None:
+            self.init(mode, pull, value=value)
+
+    def __repr__(self):
+        return f'Pin({self.id})'
+
+    def init(self, mode=-1, pull=-1, *, value=None):
+        if mode == -1:
+            mode = _board.pins.get(self.id, (Pin.IN, 0))[0]
+        if value is None:
+            value = _board.pins.get(self.id, (mode, 1 if pull == Pin.PULL_UP else 0))[1]
+        _board.set_pin(self.id, mode, value)
+
+    def value(self, value=None):
+        mode, level = _board.pins.get(self.id, (Pin.IN, 0))
+        if value is None:
+            return level
+        _board.set_pin(self.id, mode, 1 if value else 0)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+
+class ADC:
+    ATTN_0DB = 0
+    ATTN_11DB = 3
+
+    def __init__(self, pin_id, atten=ATTN_0DB):
+        self.id = pin_id.id if isinstance(pin_id, Pin) else pin_id
+
+    def read_u16(self) -> int:
+        return _board.read_adc(self.id)
+
+
+class PWM:
+    def __init__(self, pin, freq=0, duty_u16=0):
+        self.pin, self.freq, self.duty_u16 = pin, freq, duty_u16
+
+    def deinit(self):
+        pass
+
+
+class ResetError(SystemExit):
+    """Raised by machine.reset(), the simulator treats it as the end of the run."""
+
+
+def reset():
+    raise ResetError()
+
+
+class RTC:
+    def datetime(self, datetime=None):
+        if datetime is None:
+            t = _time.gmtime(utime_time() + EPOCH_2000)
+            return (t.tm_year, t.tm_mon, t.tm_mday, t.tm_wday, t.tm_hour, t.tm_min, t.tm_sec, 0)
+        year, month, day, _, hour, minute, second, _ = datetime
+        _board.clock.set_time(calendar.timegm((year, month, day, hour, minute, second)) - EPOCH_2000)
+
+    def memory(self, data=None):
+        if data is None:
+            return _board.rtc_memory
+        _board.rtc_memory = bytes(data)
+
+
+PIN_WAKE = EXT0_WAKE = 2
+TIMER_WAKE = 4
+
+
+def lightsleep(ms=None):
+    """Advances the clock by ms, or up to the first button press if esp32.wake_on_ext0() was set"""
+    started = _board.clock.monotonic()
+    seconds, reason = (ms / 1000 if ms else 0), TIMER_WAKE
+    if _board.wake_on_ext0 is not None:
+        for press in _board.button_presses:
+            if started <= press < started + seconds:
+                seconds, reason = press - started, EXT0_WAKE
+                break
+    _board.clock.advance(seconds)
+    _board.wake_reason = reason
+    _board.sleep_log.append((started, seconds, reason))
+
+
+def wake_reason() -> int:
+    return _board.wake_reason
+
+
+def wake_on_ext0(pin, level):
+    _board.wake_on_ext0 = (pin.id, level)
+
+
+def freq(hz=None):
+    if hz is None:
+        return _board.cpu_freq
+    _board.cpu_freq = hz
+
+
+# network
+class WLAN:
+    PM_NONE = 0
+    PM_PERFORMANCE = 1
+    PM_POWERSAVE = 2
+
+    def __init__(self, interface: int = 0):
+        self.interface = interface
+        self._active = False
+        self._config = {'essid': ''}
+
+    def active(self, is_active=None):
+        if is_active is None:
+            return self._active
+        self._active = bool(is_active)
+        if not self._active and self.interface == STA_IF:
+            _board.wifi_connected = False
+
+    def connect(self, ssid, password):
+        _board.wifi_connected = self._active and _board.wifi_available
+        _board.wifi_connected_at = _board.clock.monotonic() + _board.wifi_connect_sec
+
+    def disconnect(self):
+        _board.wifi_connected = False
+
+    def isconnected(self) -> bool:
+        return (self._active and _board.wifi_connected and _board.wifi_available
+                and _board.clock.monotonic() >= _board.wifi_connected_at)
+
+    def ifconfig(self):
+        return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1')
+
+    def config(self, *args, **kwargs):
+        if args:
+            return _board.mac if args[0] == 'mac' else self._config.get(args[0])
+        self._config.update(kwargs)
+
+
+STA_IF = 0
+AP_IF = 1
+
+
+def hostname(name=None):
+    return 'rsi-sim' if name is None else None
+
+
+# ntptime
+def settime():
+    if not (_board.ntp_available and _board.wifi_connected):
+        raise OSError('ETIMEDOUT')
+    _board.clock.set_time(_time.time() - EPOCH_2000)
+
+
+# urequests
+class Response:
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode()
+
+    def json(self):
+        return json.loads(self.text)
+
+    def close(self):
+        pass
+
+
+def http_get(url, timeout=None, **kwargs):
+    _board.http_log.append((_board.clock.time(), url))
+    if not _board.wifi_connected or _board.http_get is None:
+        raise OSError('ECONNABORTED')
+    return Response(*_board.http_get(url, timeout))
+
+
+# utime
+def utime_time() -> int:
+    # the accumulated float virtual time can land a hair before a whole second the scheduler asked to wake at
+    return int(_board.clock.time() + 1e-6)
+
+
+def ticks_ms() -> int:
+    return int(_board.clock.monotonic() * 1000) % TICKS_PERIOD
+
+
+def ticks_us() -> int:
+    return int(_board.clock.monotonic() * 1_000_000) % TICKS_PERIOD
+
+
+def ticks_add(ticks: int, delta: int) -> int:
+    return (ticks + delta) % TICKS_PERIOD
+
+
+def ticks_diff(end: int, start: int) -> int:
+    return ((end - start + TICKS_PERIOD // 2) % TICKS_PERIOD) - TICKS_PERIOD // 2
+
+
+def gmtime(secs=None):
+    return _time.gmtime((utime_time() if secs is None else secs) + EPOCH_2000)[:8]
+
+
+# uasyncio, MicroPython streams accept str and support readinto()
+class Stream:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    async def readline(self) -> bytes:
+        return await self.reader.readline()
+
+    async def read(self, n: int = -1) -> bytes:
+        return await self.reader.read(n)
+
+    async def readexactly(self, n: int) -> bytes:
+        return await self.reader.readexactly(n)
+
+    async def readinto(self, buf) -> int:
+        data = await self.reader.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def write(self, data) -> None:
+        self.writer.write(data.encode() if isinstance(data, str) else bytes(data))
+
+    async def drain(self) -> None:
+        await self.writer.drain()
+
+    def close(self) -> None:
+        self.writer.close()
+
+    async def wait_closed(self) -> None:
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    def get_extra_info(self, name, default=None):
+        return self.writer.get_extra_info(name, default)
+
+
+async def start_server(callback, host, port, backlog=5):
+    async def on_connection(reader, writer):
+        stream = Stream(reader, writer)
+        await callback(stream, stream)
+    return await asyncio.start_server(on_connection, host, port, backlog=backlog)
+
+
+async def sleep_ms(ms: int) -> None:
+    await asyncio.sleep(ms / 1000)
+
+
+# gc
+def mem_alloc() -> int:
+    return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+
+
+def mem_free() -> int:
+    return _board.heap_size - mem_alloc()
+
+
+# deflate (MicroPython >= 1.21), only gzip compression is used by main.py
+DEFLATE_RAW, DEFLATE_ZLIB, DEFLATE_GZIP = 1, 2, 3
+
+
+class DeflateIO:
+    def __init__(self, stream, format=DEFLATE_ZLIB, wbits=0, close=False):
+        wbits = max(9, wbits or 15)
+        wbits = {DEFLATE_RAW: -wbits, DEFLATE_ZLIB: wbits, DEFLATE_GZIP: 16 + wbits}[format]
+        self.stream = stream
+        self._close = close
+        self._compressor = zlib.compressobj(9, zlib.DEFLATED, wbits)
+
+    def write(self, data) -> int:
+        self.stream.write(self._compressor.compress(bytes(data)))
+        return len(data)
+
+    def close(self) -> None:
+        self.stream.write(self._compressor.flush())
+        if self._close:
+            self.stream.close()
+
+
+def _module(name: str, **attributes) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    return module
+
+
+def install(board: Board) -> Board:
+    """Registers the fake MicroPython modules backed by board, must be called before importing main.py"""
+    global _board
+    _board = board
+
+    uasyncio = _module('uasyncio', **{k: getattr(asyncio, k) for k in asyncio.__all__})
+    uasyncio.start_server = start_server
+    uasyncio.sleep_ms = sleep_ms
+    uasyncio.StreamReader = uasyncio.StreamWriter = Stream
+
+    sys.modules.update({
+        'machine': _module('machine', Pin=Pin, ADC=ADC, PWM=PWM, RTC=RTC, reset=reset, freq=freq, ResetError=ResetError,
+                           lightsleep=lightsleep, wake_reason=wake_reason, PIN_WAKE=PIN_WAKE, EXT0_WAKE=EXT0_WAKE,
+                           TIMER_WAKE=TIMER_WAKE),
+        'network': _module('network', WLAN=WLAN, STA_IF=STA_IF, AP_IF=AP_IF, hostname=hostname),
+        'esp32': _module('esp32', mcu_temperature=lambda: _board.mcu_temperature, wake_on_ext0=wake_on_ext0,
+                         WAKEUP_ALL_LOW=False, WAKEUP_ANY_HIGH=True),
+        'ntptime': _module('ntptime', settime=settime),
+        'urequests': _module('urequests', get=http_get, Response=Response),
+        'utime': _module('utime', time=utime_time, sleep=lambda s: _board.clock.advance(s),
+                         sleep_ms=lambda ms: _board.clock.advance(ms / 1000), ticks_ms=ticks_ms, ticks_us=ticks_us,
+                         ticks_add=ticks_add, ticks_diff=ticks_diff, gmtime=gmtime, localtime=gmtime),
+        'uasyncio': uasyncio,
+        'ujson': json,
+        'uos': os,
+        'deflate': _module('deflate', DeflateIO=DeflateIO, RAW=DEFLATE_RAW, ZLIB=DEFLATE_ZLIB, GZIP=DEFLATE_GZIP),
+        'gc': _module('gc', collect=_gc.collect, enable=_gc.enable, disable=_gc.disable, isenabled=_gc.isenabled,
+                      mem_alloc=mem_alloc, mem_free=mem_free),
+    })
+    if not hasattr(sys.implementation, '_machine'):
+        sys.implementation._machine = board.machine_name
+    return board
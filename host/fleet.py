@@ -0,0 +1,381 @@
+"""Manages a fleet of RSI controllers through their HTTP API (/status, /config and /file/).
+
+    python -m host.fleet --hosts rsi-a.local,rsi-b.local status
+    python -m host.fleet --hosts hosts.txt watch --interval 10
+    python -m host.fleet --scan 192.168.1.0/24 status
+    python -m host.fleet --hosts hosts.txt push-config config.json   # PATCHes what differs, wifi options are kept
+    python -m host.fleet --hosts hosts.txt ota main.py               # uploads, reboots and waits for the controllers
+    python -m host.fleet loadtest --devices 50 --rounds 5            # fleet refresh time against simulated controllers
+
+hosts.txt has a host[:port] per line. Requests to a controller reuse a single keep-alive connection, at most
+--concurrency controllers are talked to at a time and --rate limits the uploads per second.
+"""
+import argparse
+import asyncio
+import hashlib
+import ipaddress
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+# paths of the config that belong to a single controller, push-config leaves them alone
+LOCAL_CONFIG_PATHS: tuple = ('/options/wifi',)
+# requests that can be sent again after a failure without repeating their effect
+IDEMPOTENT_METHODS: tuple = ('GET', 'HEAD')
+
+
+class HttpError(Exception):
+    def __init__(self, status_code: int, body: bytes):
+        super().__init__(f'HTTP {status_code}: {body[:200].decode(errors="replace")}')
+        self.status_code = status_code
+
+
+class Connection:
+    """HTTP/1.1 client keeping one connection to a controller open between requests"""
+
+    def __init__(self, host: str, port: int = 80, timeout: float = 10.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connects = 0
+        self.requests = 0
+        self.body_sent = False  # the last request was written out completely
+        self._reader = None
+        self._writer = None
+
+    async def request(self, method: str, path: str, body: bytes = b'', headers: str = '') -> tuple:
+        """Returns (status code, body), headers are extra header lines"""
+        reused = self._writer is not None
+        try:
+            return await asyncio.wait_for(self._exchange(method, path, body, headers), self.timeout)
+        except (ConnectionError, asyncio.IncompleteReadError, EOFError):
+            await self.close()
+            if not reused or method not in IDEMPOTENT_METHODS:
+                raise
+        # the controller closed the idle connection, once more on a new one
+        return await asyncio.wait_for(self._exchange(method, path, body, headers), self.timeout)
+
+    async def _exchange(self, method: str, path: str, body: bytes, headers: str) -> tuple:
+        self.body_sent = False
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            self.connects += 1
+        self.requests += 1
+        self._writer.write(f'{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Length: {len(body)}\r\n'
+                           f'Connection: keep-alive\r\n{headers}\r\n'.encode() + body)
+        await self._writer.drain()
+        self.body_sent = True
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise EOFError('connection closed')
+        status_code = int(status_line.split()[1])
+        headers = {}
+        while (line := await self._reader.readline()).strip():
+            key, _, value = line.decode().partition(':')
+            headers[key.strip().lower()] = value.strip()
+        if 'content-length' in headers:
+            response = await self._reader.readexactly(int(headers['content-length']))
+        else:
+            response = await self._reader.read()
+            headers['connection'] = 'close'
+        if headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status_code, response
+
+    async def close(self) -> None:
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+
+def parse_host(host: str) -> tuple:
+    host, _, port = host.strip().partition(':')
+    return host, int(port or 80)
+
+
+def config_patch(current, desired, path: str = '') -> list:
+    """JSON Patch operations turning current into desired. Keys missing from desired are left alone, lists of a
+    different length are replaced as a whole."""
+    if path in LOCAL_CONFIG_PATHS:
+        return []
+    if isinstance(current, dict) and isinstance(desired, dict):
+        operations = []
+        for key, value in desired.items():
+            key_path = f"{path}/{key.replace('~', '~0').replace('/', '~1')}"
+            if key in current:
+                operations += config_patch(current[key], value, key_path)
+            elif key_path not in LOCAL_CONFIG_PATHS:
+                operations.append({"op": "add", "path": key_path, "value": value})
+        return operations
+    if isinstance(current, list) and isinstance(desired, list) and len(current) == len(desired):
+        return [operation for i, (a, b) in enumerate(zip(current, desired)) for operation in config_patch(a, b, f'{path}/{i}')]
+    return [] if current == desired else [{"op": "replace", "path": path, "value": desired}]
+
+
+class Fleet:
+    def __init__(self, hosts: list, concurrency: int = 16, rate: float = 0, retries: int = 3, timeout: float = 10.0):
+        self.connections = {host: Connection(*parse_host(host), timeout) for host in hosts}
+        self.retries = retries
+        self.rate = rate
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._next_upload = 0.0
+
+    async def _throttle(self) -> None:
+        if not self.rate:
+            return
+        now = time.monotonic()
+        slot, self._next_upload = max(now, self._next_upload), max(now, self._next_upload) + 1 / self.rate
+        await asyncio.sleep(slot - now)
+
+    async def request(self, host: str, method: str, path: str, body: bytes = b'', throttle: bool = False,
+                      headers: str = '') -> bytes:
+        """Retries timeouts, connection errors and 5xx of GET/HEAD with exponential backoff, raises HttpError on
+        4xx. Other methods are sent once, the controller may have applied them before failing."""
+        for attempt in range(self.retries + 1 if method in IDEMPOTENT_METHODS else 1):
+            if attempt:
+                await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+            try:
+                async with self._semaphore:
+                    if throttle:
+                        await self._throttle()
+                    status_code, response = await self.connections[host].request(method, path, body, headers)
+            except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                error = e
+                continue
+            if status_code < 300:
+                return response
+            error = HttpError(status_code, response)
+            if status_code < 500:
+                break
+        raise error
+
+    async def each(self, action) -> dict:
+        """Runs action(host) on all the controllers concurrently, returns host -> result or exception"""
+        results = await asyncio.gather(*[action(host) for host in self.connections], return_exceptions=True)
+        return dict(zip(self.connections, results))
+
+    async def status(self) -> dict:
+        async def get_status(host):
+            started = time.perf_counter()
+            status = json.loads(await self.request(host, 'GET', '/status'))
+            status['rtt_ms'] = round((time.perf_counter() - started) * 1000, 1)
+            return status
+        return await self.each(get_status)
+
+    async def push_config(self, desired: dict) -> dict:
+        async def push(host):
+            operations = config_patch(json.loads(await self.request(host, 'GET', '/config')), desired)
+            if not operations:
+                return 'up to date'
+            await self.request(host, 'PATCH', '/config', json.dumps(operations).encode(), throttle=True)
+            return f'{len(operations)} changes'
+        return await self.each(push)
+
+    async def ota(self, filename: str, data: bytes, reboot: bool = True, wait: float = 60) -> dict:
+        sha256 = hashlib.sha256(data).hexdigest()
+
+        async def update(host):
+            # the controller only replaces the file if the checksum matches
+            headers = f'X-Content-SHA256: {sha256}\r\n'
+            if not reboot:
+                await self.request(host, 'POST', f'/file/{filename}', data, throttle=True, headers=headers)
+                return 'uploaded'
+            connection = self.connections[host]
+            try:
+                async with self._semaphore:
+                    await self._throttle()
+                    # a fresh connection, a stale one would fail the upload once the body is sent
+                    await connection.close()
+                    status_code, response = await connection.request('POST', f'/file/{filename}?reboot=1', data, headers)
+                if status_code >= 300:
+                    raise HttpError(status_code, response)
+            except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                # the controller reboots before answering, sending it again would reboot it again
+                if not connection.body_sent:
+                    raise
+            started = time.monotonic()
+            await asyncio.sleep(2)
+            while True:
+                try:
+                    await self.connections[host].close()
+                    status_code, _ = await self.connections[host].request('GET', '/status')
+                    if status_code == 200:
+                        return f'back after {time.monotonic() - started:.1f}s'
+                except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    pass
+                if time.monotonic() - started > wait:
+                    raise TimeoutError(f'not back after {wait}s')
+                await asyncio.sleep(1)
+        return await self.each(update)
+
+    async def close(self) -> None:
+        await asyncio.gather(*[connection.close() for connection in self.connections.values()])
+
+
+async def scan(network: str, port: int = 80, timeout: float = 2.0, concurrency: int = 64) -> list:
+    """Hosts of network (CIDR) that answer /status like a controller"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(address):
+        async with semaphore:
+            connection = Connection(str(address), port, timeout)
+            try:
+                status_code, body = await connection.request('GET', '/status')
+                return status_code == 200 and 'valve_status' in json.loads(body)
+            except (OSError, EOFError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                return False
+            finally:
+                await connection.close()
+    addresses = list(ipaddress.ip_network(network, strict=False).hosts())
+    found = await asyncio.gather(*[probe(address) for address in addresses])
+    return [f'{address}:{port}' if port != 80 else str(address) for address, ok in zip(addresses, found) if ok]
+
+
+def format_status(results: dict) -> str:
+    columns = ('hostname', 'valve_status', 'schedule_status', 'irrigation_factor', 'soil_moisture_milli',
+               'gc.mem_free', 'rtt_ms')
+    rows = [('host',) + columns]
+    online = 0
+    for host, status in results.items():
+        if isinstance(status, Exception):
+            rows.append((host, f'offline: {status!r}'))
+            continue
+        online += 1
+        rows.append((host,) + tuple(str(status.get(column, '')) for column in columns))
+    widths = [max(len(row[i]) for row in rows if i < len(row) and len(row) > 2) for i in range(len(rows[0]))]
+    lines = ['  '.join(value.ljust(widths[i]) if len(row) > 2 else value for i, value in enumerate(row)) for row in rows]
+    watering = sum(1 for status in results.values() if isinstance(status, dict) and int(status.get('valve_status', '0'), 2))
+    lines.append(f'{online}/{len(results)} online, {watering} watering')
+    return '\n'.join(lines)
+
+
+def format_results(results: dict) -> str:
+    return '\n'.join(f'{host}: {"error: " + repr(result) if isinstance(result, Exception) else result}'
+                     for host, result in results.items())
+
+
+async def loadtest(devices: int, rounds: int, concurrency: int) -> dict:
+    """Serves devices simulated controllers on local ports and times full fleet refreshes and a config push"""
+    from host.board import Board, VirtualClock
+    from host.simulator import Simulator
+
+    board = Board(VirtualClock(accelerated=False))
+    flash_dir = tempfile.mkdtemp(prefix='rsi-fleet-')
+    servers, hosts = [], []
+    cwd = os.getcwd()
+    os.chdir(flash_dir)  # the simulated controllers share a flash directory
+    try:
+        for _ in range(devices):
+            main = Simulator(board=board, flash_dir=flash_dir).main
+            server = await main.asyncio.start_server(main.handle_request, '127.0.0.1', 0)
+            servers.append(server)
+            hosts.append(f'127.0.0.1:{server.sockets[0].getsockname()[1]}')
+
+        fleet = Fleet(hosts, concurrency=concurrency)
+        refresh_sec = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            results = await fleet.status()
+            refresh_sec.append(time.perf_counter() - started)
+        failed = sum(isinstance(result, Exception) for result in results.values())
+        rtt_ms = sorted(status['rtt_ms'] for status in results.values() if isinstance(status, dict))
+
+        desired = json.loads(await fleet.request(hosts[0], 'GET', '/config'))
+        desired['schedules'][0]['duration_sec'] += 60
+        started = time.perf_counter()
+        pushed = await fleet.push_config(desired)
+        push_sec = time.perf_counter() - started
+        await fleet.close()
+        return {
+            "devices": devices,
+            "rounds": rounds,
+            "concurrency": concurrency,
+            "refresh_sec_min": round(min(refresh_sec), 4),
+            "refresh_sec_median": round(statistics.median(refresh_sec), 4),
+            "refresh_sec_max": round(max(refresh_sec), 4),
+            "refreshes_per_sec": round(devices / statistics.median(refresh_sec), 1),
+            "rtt_ms_p50": rtt_ms[len(rtt_ms) // 2] if rtt_ms else None,
+            "rtt_ms_p99": rtt_ms[min(len(rtt_ms) - 1, len(rtt_ms) * 99 // 100)] if rtt_ms else None,
+            "failed": failed,
+            "connects_per_device": round(sum(c.connects for c in fleet.connections.values()) / devices, 2),
+            "push_config_sec": round(push_sec, 4),
+            "push_failed": sum(isinstance(result, Exception) for result in pushed.values()),
+        }
+    finally:
+        for server in servers:
+            server.close()
+        await asyncio.sleep(0.1)  # lets the controllers close their side of the connections
+        os.chdir(cwd)
+
+
+def read_hosts(hosts: str) -> list:
+    if os.path.exists(hosts):
+        with open(hosts) as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return [host for host in hosts.split(',') if host]
+
+
+async def run(args) -> None:
+    if args.command == 'loadtest':
+        print(json.dumps(await loadtest(args.devices, args.rounds, args.concurrency), indent=2))
+        return
+
+    hosts = read_hosts(args.hosts) if args.hosts else []
+    if args.scan:
+        hosts += await scan(args.scan)
+    if not hosts:
+        sys.exit('no controllers, use --hosts or --scan')
+    fleet = Fleet(hosts, args.concurrency, args.rate, args.retries, args.timeout)
+    try:
+        if args.command == 'status':
+            print(format_status(await fleet.status()))
+        elif args.command == 'watch':
+            while True:
+                started = time.perf_counter()
+                results = await fleet.status()
+                print(f'\x1b[2J\x1b[H{time.strftime("%H:%M:%S")} refreshed in {time.perf_counter() - started:.2f}s')
+                print(format_status(results))
+                await asyncio.sleep(args.interval)
+        elif args.command == 'push-config':
+            with open(args.file) as f:
+                print(format_results(await fleet.push_config(json.load(f))))
+        elif args.command == 'ota':
+            with open(args.file, 'rb') as f:
+                data = f.read()
+            print(format_results(await fleet.ota(os.path.basename(args.file), data, not args.no_reboot, args.wait)))
+    finally:
+        await fleet.close()
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hosts', help='comma separated host[:port] list or a file with one per line')
+    parser.add_argument('--scan', help='network to scan for controllers, e.g. 192.168.1.0/24')
+    parser.add_argument('--concurrency', type=int, default=16, help='controllers talked to at the same time')
+    parser.add_argument('--rate', type=float, default=2, help='uploads (config/OTA) started per second, 0 is unlimited')
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=10)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status')
+    commands.add_parser('watch').add_argument('--interval', type=float, default=10)
+    commands.add_parser('push-config').add_argument('file')
+    ota = commands.add_parser('ota')
+    ota.add_argument('file')
+    ota.add_argument('--no-reboot', action='store_true')
+    ota.add_argument('--wait', type=float, default=60, help='seconds to wait for the controller to come back')
+    loadtest_parser = commands.add_parser('loadtest')
+    loadtest_parser.add_argument('--devices', type=int, default=20)
+    loadtest_parser.add_argument('--rounds', type=int, default=5)
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,458 @@
+"""Load and memory benchmark of main.py's HTTP server, against a simulated controller or a real one.
+
+    python -m host.httpbench                            # simulated controller, compared with the stored baseline
+    python -m host.httpbench --save-baseline            # store the results as the new baseline
+    python -m host.httpbench --url http://rsi.local     # replay on a controller, it gets its own config back and a bench.bin
+
+The simulated controller runs in a subprocess (python -m host.httpbench --serve) so that only the server's
+allocations are traced: the peak heap above idle per scenario, and the peak of a single request per route, measured
+one request at a time. A real controller reports its heap high-water mark instead. The baseline only holds results
+of the simulated controller, timings depend on the host so compare runs of the same machine.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from asyncio import selector_events
+
+from host.fleet import Connection, parse_host
+
+REPO_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE: str = os.path.join(REPO_DIR, 'host', 'httpbench_baseline.json')
+TCP_MSS: int = 1460
+HISTORY_INTERVAL_SEC: int = 300
+GZIP: str = 'Accept-Encoding: gzip, deflate\r\n'
+# what index.html requests after the page itself, /events is held open for the whole visit
+PAGE_RESOURCES: tuple = (('GET /favicon.ico', '/favicon.ico'), ('GET /config', '/config'),
+                         ('GET /status', '/status'), ('GET /history', '/history'))
+SERVED_FRACTION_TOLERANCE: float = 0.1
+MIXED_REQUESTS: tuple = (('GET /status', 60), ('GET /config', 25), ('PATCH /config', 10), ('POST /config', 5))
+
+
+def percentile_ms(values: list, fraction: float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 2)
+
+
+class Recorder:
+    """Latency per route and status code counts of a scenario"""
+
+    def __init__(self):
+        self.latency = {}   # route -> [seconds]
+        self.status_codes = {}
+        self.errors = 0
+
+    async def timed(self, route: str, request) -> tuple:
+        """Awaits request (a Connection.request()), returns (status code, body) or None on a connection error"""
+        started = time.perf_counter()
+        try:
+            status_code, body = await request
+        except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            self.errors += 1
+            return None
+        self.latency.setdefault(route, []).append(time.perf_counter() - started)
+        self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+        return status_code, body
+
+    def summary(self, seconds: float) -> dict:
+        latency = [value for values in self.latency.values() for value in values]
+        return {
+            "requests": len(latency),
+            "requests_per_sec": round(len(latency) / seconds, 1),
+            "p50_ms": percentile_ms(latency, 0.5),
+            "p99_ms": percentile_ms(latency, 0.99),
+            "errors": self.errors,
+            "status_codes": {str(code): count for code, count in sorted(self.status_codes.items())},
+            "routes": {route: {"requests": len(values), "p50_ms": percentile_ms(values, 0.5),
+                               "p99_ms": percentile_ms(values, 0.99)}
+                       for route, values in sorted(self.latency.items())},
+        }
+
+
+async def read_config(address: tuple) -> dict:
+    connection = Connection(*address)
+    try:
+        return json.loads((await connection.request('GET', '/config'))[1])
+    finally:
+        await connection.close()
+
+
+def config_patch(config: dict) -> bytes:
+    """A PATCH /config that changes nothing: the first schedule's duration, or the timezone without schedules"""
+    if config['schedules']:
+        operation = {"op": "replace", "path": "/schedules/0/duration_sec", "value": config['schedules'][0]['duration_sec']}
+    else:
+        operation = {"op": "replace", "path": "/options/settings/timezone_offset",
+                     "value": config['options']['settings']['timezone_offset']}
+    return json.dumps([operation]).encode()
+
+
+async def scenario_status(address: tuple, seconds: float, recorder: Recorder, args) -> dict:
+    """args.clients keep-alive clients polling /status"""
+    deadline = time.perf_counter() + seconds
+
+    async def client():
+        connection = Connection(*address)
+        while time.perf_counter() < deadline:
+            await recorder.timed('GET /status', connection.request('GET', '/status'))
+        await connection.close()
+
+    await asyncio.gather(*[client() for _ in range(args.clients)])
+
+
+async def scenario_mixed(address: tuple, seconds: float, recorder: Recorder, args) -> dict:
+    """args.clients keep-alive clients reading and writing the config, see MIXED_REQUESTS"""
+    config = await read_config(address)
+    bodies = {'PATCH /config': config_patch(config), 'POST /config': json.dumps(config).encode()}
+    routes = [route for route, weight in MIXED_REQUESTS for _ in range(weight)]
+    deadline = time.perf_counter() + seconds
+
+    async def client(seed: int):
+        rng = random.Random(seed)
+        connection = Connection(*address)
+        while time.perf_counter() < deadline:
+            route = rng.choice(routes)
+            method, path = route.split(' ')
+            await recorder.timed(route, connection.request(method, path, bodies.get(route, b'')))
+        await connection.close()
+
+    await asyncio.gather(*[client(seed) for seed in range(args.clients)])
+
+
+async def scenario_page_load(address: tuple, seconds: float, recorder: Recorder, args) -> dict:
+    """args.browsers dashboards, each holding /events open and reloading the page over 2 connections. On a simulated
+    controller every page load also starts a 1 second manual run of zone 0, a status change for the streams."""
+    deadline = time.perf_counter() + seconds
+    pages = []
+    events = {"received": 0, "streams_closed": 0, "streams_refused": 0}
+
+    async def listen_events():
+        reader, writer = await asyncio.open_connection(*address)
+        writer.write(b'GET /events HTTP/1.1\r\nHost: bench\r\n\r\n')
+        try:
+            if b' 503 ' in await reader.readline():
+                # beyond the controller's stream cap, the dashboard polls instead
+                events['streams_refused'] += 1
+                return
+            while data := await reader.read(1024):
+                events['received'] += data.count(b'data: ')
+            # the controller ended the stream while the dashboard was still open
+            events['streams_closed'] += 1
+        finally:
+            writer.close()
+
+    async def browser():
+        listener = asyncio.create_task(listen_events())
+        connections = [Connection(*address), Connection(*address)]
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            await recorder.timed('GET /', connections[0].request('GET', '/', headers=GZIP))
+            for i in range(0, len(PAGE_RESOURCES), len(connections)):
+                await asyncio.gather(*[recorder.timed(route, connection.request('GET', path))
+                                       for connection, (route, path) in zip(connections, PAGE_RESOURCES[i:])])
+            pages.append(time.perf_counter() - started)
+            if not args.url:
+                await recorder.timed('POST /zone/', connections[0].request('POST', '/zone/0/run?duration=1'))
+        listener.cancel()
+        for connection in connections:
+            await connection.close()
+
+    await asyncio.gather(*[browser() for _ in range(args.browsers)])
+    return {"pages": len(pages), "page_p50_ms": percentile_ms(pages, 0.5), "page_p99_ms": percentile_ms(pages, 0.99),
+            "events": events['received'], "event_streams_closed": events['streams_closed'],
+            "event_streams_refused": events['streams_refused']}
+
+
+async def scenario_upload(address: tuple, seconds: float, recorder: Recorder, args) -> dict:
+    """Back to back args.upload_kb uploads of bench.bin, verified with X-Content-SHA256"""
+    data = random.Random(0).randbytes(args.upload_kb * 1024)
+    headers = f'X-Content-SHA256: {hashlib.sha256(data).hexdigest()}\r\n'
+    connection = Connection(*address, timeout=120)
+    uploaded = 0
+    started = time.perf_counter()
+    while time.perf_counter() < started + seconds or not uploaded:
+        result = await recorder.timed('POST /file/', connection.request('POST', '/file/bench.bin', data, headers))
+        if result is None or result[0] != 200:
+            break
+        uploaded += len(data)
+    await connection.close()
+    return {"upload_mb_per_sec": round(uploaded / (time.perf_counter() - started) / 1e6, 3)}
+
+
+async def scenario_slowloris(address: tuple, seconds: float, recorder: Recorder, args) -> dict:
+    """args.slowloris clients trickling a request line a byte every 0.5 seconds, every other one sending a PATCH head
+    and stalling in its body instead (reconnecting once dropped), while 2 clients poll /status on a new connection
+    each, runs twice as long to cover the server's idle timeout"""
+    deadline = time.perf_counter() + 2 * seconds
+    attacks = 0
+    stalls_dropped = 0
+
+    async def attacker(stall_body: bool):
+        nonlocal attacks
+        nonlocal stalls_dropped
+        while time.perf_counter() < deadline:
+            writer = None
+            try:
+                reader, writer = await asyncio.open_connection(*address)
+                attacks += 1
+                if stall_body:
+                    writer.write(b'PATCH /config HTTP/1.1\r\nHost: bench\r\nContent-Length: 100\r\n\r\n[')
+                    await writer.drain()
+                    # until the controller drops the connection
+                    await asyncio.wait_for(reader.read(), deadline - time.perf_counter())
+                    stalls_dropped += 1
+                    continue
+                for byte in b'GET /status HTTP/1.1\r\nHost: bench\r\n':
+                    if time.perf_counter() >= deadline:
+                        break
+                    writer.write(bytes([byte]))
+                    await writer.drain()
+                    await asyncio.sleep(0.5)
+            except (OSError, asyncio.TimeoutError):
+                await asyncio.sleep(0.1)
+            finally:
+                if writer:
+                    writer.close()
+
+    async def client():
+        while time.perf_counter() < deadline:
+            connection = Connection(*address)
+            await recorder.timed('GET /status', connection.request('GET', '/status', headers='Connection: close\r\n'))
+            await connection.close()
+            await asyncio.sleep(0.05)
+
+    await asyncio.gather(*[attacker(i % 2 == 1) for i in range(args.slowloris)], client(), client())
+    served = recorder.status_codes.get(200, 0)
+    return {"attack_connections": attacks, "stalled_bodies_dropped": stalls_dropped,
+            "served_fraction": round(served / max(1, sum(recorder.status_codes.values()) + recorder.errors), 3)}
+
+
+SCENARIOS: dict = {
+    "status": scenario_status,
+    "mixed": scenario_mixed,
+    "page_load": scenario_page_load,
+    "upload": scenario_upload,
+    "slowloris": scenario_slowloris,
+}
+
+
+async def measure_routes(controller) -> None:
+    """One request at a time to every route, 3 times each, for the per-request allocation peaks. The first pass
+    isn't measured, it pays for one-off work such as compressing index.html."""
+    config = await read_config(controller.address)
+    upload = random.Random(1).randbytes(64 * 1024)
+    requests = [('GET', '/', b'', GZIP), ('GET', '/favicon.ico', b'', ''), ('GET', '/config', b'', ''),
+                ('POST', '/config', json.dumps(config).encode(), ''), ('PATCH', '/config', config_patch(config), ''),
+                ('GET', '/status', b'', ''), ('GET', '/history', b'', ''), ('GET', '/metrics', b'', ''),
+                ('GET', '/log', b'', ''), ('POST', '/file/bench.bin', upload, ''), ('GET', '/file/bench.bin', b'', '')]
+    connection = Connection(*controller.address, timeout=60)
+    for run in range(4):
+        if run == 1:
+            await controller.command('measure')
+        for method, path, body, headers in requests:
+            await connection.request(method, path, body, headers)
+    await connection.close()
+
+
+class LocalController:
+    """A simulated controller in a subprocess, commands go through its stdin/stdout"""
+
+    async def start(self) -> None:
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'host.httpbench', '--serve', cwd=REPO_DIR,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        self.address = ('127.0.0.1', json.loads(await self.process.stdout.readline())['port'])
+
+    async def command(self, command: str) -> dict:
+        self.process.stdin.write(command.encode() + b'\n')
+        await self.process.stdin.drain()
+        return json.loads(await self.process.stdout.readline())
+
+    async def stop(self) -> None:
+        self.process.stdin.close()
+        await self.process.wait()
+
+
+class RemoteController:
+    """A controller on the network, reports the heap high-water mark of its /metrics"""
+
+    def __init__(self, url: str):
+        self.address = parse_host(url.split('://')[-1].rstrip('/'))
+
+    async def start(self) -> None:
+        pass
+
+    async def command(self, command: str) -> dict:
+        if command != 'peak':
+            return {}
+        connection = Connection(*self.address)
+        try:
+            metrics = (await connection.request('GET', '/metrics'))[1].decode()
+        finally:
+            await connection.close()
+        for line in metrics.splitlines():
+            if line.startswith('rsi_heap_high_water_bytes '):
+                return {"heap_high_water_bytes": int(line.split()[1])}
+        return {}
+
+    async def stop(self) -> None:
+        pass
+
+
+async def run_bench(args) -> dict:
+    controller = RemoteController(args.url) if args.url else LocalController()
+    await controller.start()
+    try:
+        results = {"target": args.url or 'simulated', "seconds": args.seconds, "scenarios": {}}
+        for name in args.scenarios.split(','):
+            await controller.command('reset')
+            recorder = Recorder()
+            started = time.perf_counter()
+            extra = await SCENARIOS[name](controller.address, args.seconds, recorder, args)
+            results['scenarios'][name] = {**recorder.summary(time.perf_counter() - started), **(extra or {}),
+                                          **await controller.command('peak')}
+            await asyncio.sleep(0.2)    # lets the server drop the scenario's connections
+        await measure_routes(controller)
+        results['route_peak_bytes'] = await controller.command('routes')
+        return results
+    finally:
+        await controller.stop()
+
+
+async def serve() -> None:
+    """Runs a simulated controller on a free port, prints {"port"} and answers the commands read from stdin:
+    reset (the heap peak), peak (bytes above the heap at reset), measure (per-request peaks from now on), routes"""
+    from host.board import Board, VirtualClock
+    from host.simulator import Simulator
+
+    sim = Simulator(board=Board(VirtualClock(accelerated=False)))
+    main = sim.main
+    handle_http_request = main.handle_http_request
+    observe = main.observe
+    route_peaks = {}
+    state = {"measure": False, "route": None, "allocated": 0}
+
+    def observing(histogram, duration_us: int) -> None:
+        for i, route_histogram in enumerate(main.http_request_latency):
+            if route_histogram is histogram:
+                state['route'] = ' '.join(main.HTTP_ROUTES[i])
+        observe(histogram, duration_us)
+
+    async def measured_http_request(reader, writer, keep_alive: bool) -> bool:
+        if not state['measure']:
+            return await handle_http_request(reader, writer, keep_alive)
+        tracemalloc.reset_peak()
+        allocated = tracemalloc.get_traced_memory()[0]
+        state['route'] = None
+        try:
+            return await handle_http_request(reader, writer, keep_alive)
+        finally:
+            if state['route']:
+                peak = tracemalloc.get_traced_memory()[1] - allocated
+                route_peaks[state['route']] = max(route_peaks.get(state['route'], 0), peak)
+
+    main.observe = observing
+    main.handle_http_request = measured_http_request
+    # CPython receives into a new 256 KB buffer per read, that would hide every request's own allocations
+    selector_events._SelectorSocketTransport.max_size = TCP_MSS
+    tracemalloc.start()
+    loop = asyncio.get_running_loop()
+    with sim.flash():
+        # a day of history for GET /history, every HISTORY_INTERVAL_SEC
+        main.open_history()
+        now = int(main.time.time())
+        for timestamp in range(now - 86400, now, HISTORY_INTERVAL_SEC):
+            main.append_history(timestamp)
+        server = await main.asyncio.start_server(main.handle_request, '127.0.0.1', 0)
+        reply = sys.__stdout__
+        reply.write(json.dumps({"port": server.sockets[0].getsockname()[1]}) + '\n')
+        reply.flush()
+        while command := (await loop.run_in_executor(None, sys.stdin.readline)).strip():
+            if command == 'reset':
+                tracemalloc.reset_peak()
+                state['allocated'] = tracemalloc.get_traced_memory()[0]
+                response = {}
+            elif command == 'peak':
+                response = {"heap_peak_bytes": tracemalloc.get_traced_memory()[1] - state['allocated']}
+            elif command == 'measure':
+                state['measure'] = True
+                response = {}
+            else:
+                response = dict(sorted(route_peaks.items()))
+            reply.write(json.dumps(response) + '\n')
+            reply.flush()
+        server.close()
+        # left to asyncio.run() to cancel, Python 3.11's start_server() reports the cancelled handlers as errors
+        loop.set_exception_handler(lambda loop, context: None if isinstance(context.get('exception'), asyncio.CancelledError)
+                                   else loop.default_exception_handler(context))
+
+
+def compare(results: dict, baseline: dict, tolerance: float, alloc_tolerance: float) -> list:
+    """Regressions against baseline by more than a factor of 1 + tolerance: fewer requests/s or a higher median
+    latency, and 1 + alloc_tolerance: a higher allocation peak of a route. Also a served fraction (slowloris) lower by
+    SERVED_FRACTION_TOLERANCE, any more event streams closed under the dashboards and stalled request bodies no longer
+    dropped. p99 and the scenarios' heap
+    peaks depend on how the concurrent requests interleave, they're only reported."""
+    regressions = []
+    for name, scenario in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if not base:
+            continue
+        if scenario['requests_per_sec'] * (1 + tolerance) < base['requests_per_sec']:
+            regressions.append(f"{name}: {scenario['requests_per_sec']} requests/s, baseline {base['requests_per_sec']}")
+        if scenario['p50_ms'] and base['p50_ms'] and scenario['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {scenario['p50_ms']}ms, baseline {base['p50_ms']}ms")
+        if 'served_fraction' in base and scenario['served_fraction'] < base['served_fraction'] - SERVED_FRACTION_TOLERANCE:
+            regressions.append(f"{name}: served {scenario['served_fraction']}, baseline {base['served_fraction']}")
+        if scenario.get('event_streams_closed', 0) > base.get('event_streams_closed', 0):
+            regressions.append(f"{name}: {scenario['event_streams_closed']} event streams closed by the controller")
+        if base.get('stalled_bodies_dropped') and not scenario.get('stalled_bodies_dropped'):
+            regressions.append(f"{name}: stalled request bodies hold their connections")
+    for route, peak in results['route_peak_bytes'].items():
+        base = baseline.get('route_peak_bytes', {}).get(route)
+        if base and peak > base * (1 + alloc_tolerance):
+            regressions.append(f"{route}: allocation peak {peak}, baseline {base}")
+    return regressions
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='benchmark this controller instead of a simulated one')
+    parser.add_argument('--seconds', type=float, default=3, help='duration of each scenario')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--clients', type=int, default=4, help='concurrent clients of the status and mixed scenarios')
+    parser.add_argument('--browsers', type=int, default=2, help='concurrent dashboards of the page_load scenario')
+    parser.add_argument('--slowloris', type=int, default=8, help='slow clients of the slowloris scenario')
+    parser.add_argument('--upload-kb', type=int, default=256)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='allowed slowdown, 1 is twice slower (timings are noisy)')
+    parser.add_argument('--alloc-tolerance', type=float, default=0.25, help='allowed growth of the allocation peaks')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        asyncio.run(serve())
+        return
+    results = asyncio.run(run_bench(args))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    elif not args.url and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            results['regressions'] = compare(results, json.load(f), args.tolerance, args.alloc_tolerance)
+    print(json.dumps(results, indent=2))
+    if results.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,451 @@
+"""Time-accelerated simulator for main.py.
+
+    python -m host.simulator --days 28                 # print every valve transition
+    python -m host.simulator --days 28 --bench         # simulated-days-per-second & allocations per scheduler tick
+    python -m host.simulator --boot                    # time to the first scheduler tick after a power loss
+    python -m host.simulator --days 7 --power-save     # light-sleep duty cycle & wake-ups without WiFi coverage
+    python -m host.simulator --config config.json --soil 20,150
+    python -m host.simulator --soil 0:700,21600:350,64800:250   # the same soil moisture curve every day
+    python -m host.simulator --verify 20 --days 2      # compare the scheduler with the original loop over random configs
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from host.board import EPOCH_2000, Board, VirtualClock, VirtualEventLoop, install
+
+REPO_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEMO_CONFIG: dict = {
+    "zones": [
+        {"name": "master", "master": True, "on_pin": 5, "off_pin": 5},
+        {"name": "lawn", "on_pin": 6, "off_pin": 7},
+        {"name": "garden", "on_pin": 8, "off_pin": 9},
+    ],
+    "schedules": [
+        {"zone_id": 1, "start_sec": 6 * 3600, "duration_sec": 900, "enable_irrigation_factor": True, "enabled": True},
+        {"zone_id": 2, "start_sec": 6 * 3600 + 600, "duration_sec": 600, "enable_irrigation_factor": True, "enabled": True},
+        {"zone_id": 2, "start_sec": 86400 - 300, "duration_sec": 900, "enable_irrigation_factor": False, "enabled": True},
+    ],
+    "options": {
+        "wifi": {"ssid": "sim", "hostname": "rsi-sim"},
+        "irrigation_factor": {"reference_schedule_id": 0},
+        "settings": {"timezone_offset": 0},
+    },
+}
+
+
+def load_main(path: str = os.path.join(REPO_DIR, 'main.py')):
+    """Imports a fresh copy of main.py, install() must have been called before"""
+    spec = importlib.util.spec_from_file_location('main', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def milli_to_raw(milli: float, high_is_dry: bool = True) -> int:
+    """Inverse of main.get_soil_moisture_milli()"""
+    milli = max(0, min(1000, milli))
+    return min(65535, round((1000 - milli if high_is_dry else milli) * 65.6))
+
+
+def soil_curve(points: list, period: float = 86400, high_is_dry: bool = True):
+    """Piecewise linear [(seconds since the start of the period, soil_moisture_milli), ...] repeating every period"""
+    points = sorted(points)
+
+    def read(timestamp: float) -> int:
+        t = timestamp % period
+        previous = (points[-1][0] - period, points[-1][1])
+        for point in points + [(points[0][0] + period, points[0][1])]:
+            if t <= point[0]:
+                span = point[0] - previous[0]
+                milli = previous[1] + (point[1] - previous[1]) * ((t - previous[0]) / span if span else 0)
+                return milli_to_raw(milli, high_is_dry)
+            previous = point
+        return milli_to_raw(points[-1][1], high_is_dry)
+    return read
+
+
+class Simulator:
+    def __init__(self, config: dict = None, start: float = 0, board: Board = None, flash_dir: str = None):
+        self.board = install(board or Board(VirtualClock(start or 24 * 365 * 86400)))
+        self.clock = self.board.clock
+        self.flash_dir = flash_dir or tempfile.mkdtemp(prefix='rsi-flash-')
+        for filename in ['index.html', 'setup.html']:
+            if os.path.exists(os.path.join(REPO_DIR, filename)):
+                shutil.copy(os.path.join(REPO_DIR, filename), self.flash_dir)
+        self.transitions = []   # (local_timestamp, old valve_status, new valve_status)
+        self.ticks = 0
+        self.tick_alloc_bytes = []
+        self.tick_alloc_blocks = []
+        self.services = []      # coroutine functions run alongside main's tasks, e.g. stand-in servers
+        self.output = io.StringIO()
+        # a single loop for all the runs, main's asyncio.Event/Lock globals are bound to the first loop using them
+        self.loop = VirtualEventLoop(self.clock)
+
+        with self.flash():
+            self.main = load_main()
+            self.main.apply_config(config if config is not None else DEMO_CONFIG)
+        self._wrap_main()
+
+    @contextlib.contextmanager
+    def flash(self):
+        """Runs with the flash directory as cwd and main.py's prints captured in self.output"""
+        cwd = os.getcwd()
+        os.chdir(self.flash_dir)
+        try:
+            with contextlib.redirect_stdout(self.output):
+                yield
+        finally:
+            os.chdir(cwd)
+
+    def _wrap_main(self) -> None:
+        main = self.main
+        apply_valves = main.apply_valves
+        evaluate_schedules = main.evaluate_schedules
+
+        async def recording_apply_valves(new_status: int) -> None:
+            old_status, local_timestamp = main.valve_status, main.get_local_timestamp()
+            await apply_valves(new_status)
+            if main.valve_status != old_status:
+                self.transitions.append((local_timestamp, old_status, main.valve_status))
+
+        def counting_evaluate_schedules(local_timestamp: int) -> tuple:
+            self.ticks += 1
+            if not tracemalloc.is_tracing():
+                return evaluate_schedules(local_timestamp)
+            blocks = sys.getallocatedblocks()
+            tracemalloc.reset_peak()
+            allocated = tracemalloc.get_traced_memory()[0]
+            result = evaluate_schedules(local_timestamp)
+            self.tick_alloc_bytes.append(tracemalloc.get_traced_memory()[1] - allocated)
+            self.tick_alloc_blocks.append(sys.getallocatedblocks() - blocks)
+            return result
+
+        main.apply_valves = recording_apply_valves
+        main.evaluate_schedules = counting_evaluate_schedules
+
+    def soil_moisture(self, source) -> None:
+        """Feeds read_soil_moisture_raw() from source(clock.time()) -> raw u16"""
+        self.board.adc[self.main.config['options']['soil_moisture_sensor']['adc_pin_id']] = source
+
+    def soil_model(self, dry_per_hour: float, wet_per_hour: float, initial_milli: float = 500) -> None:
+        """Soil dries at a constant rate and gets wetter while any valve is open"""
+        state = {'milli': initial_milli, 'at': self.clock.time()}
+        high_is_dry = self.main.config['options']['soil_moisture_sensor']['high_is_dry']
+
+        def read(timestamp: float) -> int:
+            rate = wet_per_hour if self.main.valve_status else -dry_per_hour
+            state['milli'] = max(0, min(1000, state['milli'] + rate * (timestamp - state['at']) / 3600))
+            state['at'] = timestamp
+            return milli_to_raw(state['milli'], high_is_dry)
+        self.soil_moisture(read)
+
+    def soil_script(self, points: list, period: float = 86400) -> None:
+        """Soil moisture follows soil_curve(points, period), the periods start at local midnight"""
+        curve = soil_curve(points, period, self.main.config['options']['soil_moisture_sensor']['high_is_dry'])
+        self.soil_moisture(lambda timestamp: curve(timestamp + self.main.micropython_to_localtime))
+
+    def run(self, seconds: float, *tasks) -> None:
+        """Runs schedule_irrigation() and sample_soil_moisture() (plus extra coroutine functions of main) for seconds
+        of simulated time"""
+        async def run_tasks():
+            running = [asyncio.create_task(service()) for service in self.services]
+            running += [asyncio.create_task(getattr(self.main, name)())
+                        for name in ('schedule_irrigation', 'sample_soil_moisture') + tasks]
+            await asyncio.sleep(seconds)
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+        with self.flash():
+            self.loop.run_until_complete(run_tasks())
+
+    def bench(self, days: float) -> dict:
+        ticks, started = self.ticks, time.perf_counter()
+        self.run(days * 86400)
+        wall_sec = time.perf_counter() - started
+        speed_ticks = self.ticks - ticks
+
+        tracemalloc.start()
+        try:
+            self.run(86400)
+        finally:
+            tracemalloc.stop()
+        samples = len(self.tick_alloc_bytes) or 1
+        return {
+            "simulated_days": days,
+            "wall_sec": round(wall_sec, 3),
+            "simulated_days_per_sec": round(days / wall_sec, 1),
+            "ticks_per_day": round(speed_ticks / days, 1),
+            "transitions": len(self.transitions),
+            "alloc_bytes_per_tick": round(sum(self.tick_alloc_bytes) / samples, 1),
+            "alloc_bytes_per_tick_max": max(self.tick_alloc_bytes, default=0),
+            "alloc_blocks_per_tick": round(sum(self.tick_alloc_blocks) / samples, 2),
+        }
+
+
+    def boot(self, seconds: float = 60, wifi_connect_sec: float = 4, power_loss: bool = True) -> dict:
+        """Saves the config and a clock snapshot, optionally loses the RTC like on a power loss, then runs main.main()
+        for seconds of simulated time and reports when the scheduler, WiFi and NTP came up"""
+        main = self.main
+        with self.flash():
+            main.save_config()
+            main.save_clock_snapshot(True)
+        true_time = self.clock.time()
+        if power_loss:
+            self.clock.set_time(0)
+            self.board.rtc_memory = b''
+        self.board.wifi_connect_sec = wifi_connect_sec
+        main.HTTP_PORT = 0
+        started = self.clock.monotonic()
+        milestones = {}
+
+        async def watch():
+            while True:
+                if main.boot_first_tick_ms is not None and 'first_tick_sec' not in milestones:
+                    milestones['first_tick_sec'] = round(main.boot_first_tick_ms / 1000 - started, 3)
+                    milestones['clock_source_at_first_tick'] = main.clock_source
+                    milestones['clock_error_sec'] = round(main.time.time() - (true_time + self.clock.monotonic() - started))
+                if main.wlan.isconnected():
+                    milestones.setdefault('wifi_connected_sec', round(self.clock.monotonic() - started, 3))
+                if main.clock_source == 'ntp':
+                    milestones.setdefault('ntp_synced_sec', round(self.clock.monotonic() - started, 3))
+                await asyncio.sleep(0.01)
+
+        async def run_main():
+            asyncio.create_task(main.main())
+            asyncio.create_task(watch())
+            await asyncio.sleep(seconds)
+            # main() leaves its tasks running
+            running = asyncio.all_tasks() - {asyncio.current_task()}
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+        with self.flash():
+            self.loop.run_until_complete(run_main())
+            load_us = {}
+            for source, load in (('config.json', lambda: main.load_from_json('config.json')),
+                                 (main.CONFIG_CACHE_FILE, main.load_config_cache)):
+                started_wall = time.perf_counter()
+                for _ in range(100):
+                    main.apply_config(load())
+                load_us[source] = round((time.perf_counter() - started_wall) * 10_000, 1)
+        return {**milestones, "config_load_us": load_us}
+
+
+def power_report(config: dict, days: float) -> dict:
+    """Runs config without WiFi coverage, without and with settings.power_save: reports the estimated duty cycle and
+    wake-ups, and how much later the valves switched with power saving"""
+    config = json.loads(json.dumps(config if config is not None else DEMO_CONFIG))
+    runs = []
+    for power_save in (False, True):
+        config['options'].setdefault('settings', {})['power_save'] = power_save
+        sim = Simulator(config)
+        sim.board.wifi_available = False
+        sim.run(days * 86400, 'manage_power', 'keep_wifi_connected', 'periodic_ntp_sync', 'snapshot_clock',
+                'record_history', 'send_metrics')
+        runs.append(sim)
+    baseline, sim = runs
+    status = sim.main.get_status()
+    delays = [transition[0] - expected[0] for transition, expected in zip(sim.transitions, baseline.transitions)]
+    return {
+        "simulated_days": days,
+        "duty_cycle": status['power.duty_cycle'],
+        "wakes": status['power.wakes'],
+        "wakes_per_hour": round(status['power.wakes'] / (days * 24), 1),
+        "button_wakes": sum(1 for _, _, reason in sim.board.sleep_log if reason == sim.main.EXT0_WAKE),
+        "transitions": len(sim.transitions),
+        "transitions_match": [t[1:] for t in sim.transitions] == [t[1:] for t in baseline.transitions],
+        "max_transition_delay_sec": max(delays, default=0),
+    }
+
+
+class ReferenceScheduler:
+    """An iteration of main.py's original scheduler loop (polling every 2 seconds), evaluate() is what it set the
+    valves and schedule_status to at local_timestamp"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.irrigation_factor = 1
+        self.irrigation_factor_expiration = 0
+        self.schedule_status = 0
+
+    def evaluate(self, local_timestamp: int, soil_moisture: int) -> tuple:
+        options = self.config['options']
+        if options['irrigation_factor']['override'] >= 0:
+            self.irrigation_factor = options['irrigation_factor']['override']
+        elif local_timestamp > self.irrigation_factor_expiration:
+            self.irrigation_factor = 1
+
+        valve_desired = 0
+        new_schedule_status = 0
+        for i, s in enumerate(self.config['schedules']):
+            if not options['settings']['enable_irrigation_schedule'] or not s['enabled']:
+                continue
+            if s['expiry'] and local_timestamp > s['expiry']:
+                continue
+            sec_till_start = (86400 + s['start_sec'] - local_timestamp % 86400) % 86400
+            duration_sec = round(s['duration_sec'])
+            sec_till_end = (sec_till_start + duration_sec) % 86400
+            if sec_till_end >= sec_till_start:
+                continue
+            if (options['irrigation_factor']['reference_schedule_id'] == i and
+                    self.irrigation_factor_expiration <= local_timestamp + sec_till_end and soil_moisture is not None):
+                if self.schedule_status & (1 << i):
+                    if soil_moisture >= options['irrigation_factor']['soil_moisture_wet']:
+                        self.irrigation_factor = (local_timestamp - s['start_sec']) % 86400 / s['duration_sec']
+                        self.irrigation_factor_expiration = local_timestamp + sec_till_start + duration_sec
+                elif soil_moisture >= options['irrigation_factor']['soil_moisture_dry']:
+                    self.irrigation_factor = 0
+                    self.irrigation_factor_expiration = local_timestamp + sec_till_start + duration_sec
+            if s['enable_irrigation_factor']:
+                duration_sec *= self.irrigation_factor
+                sec_till_end = (sec_till_start + duration_sec) % 86400
+                if sec_till_end >= sec_till_start:
+                    continue
+            valve_desired |= 1 << s['zone_id']
+            new_schedule_status |= 1 << i
+
+        if valve_desired > 0:
+            for i, zone in enumerate(self.config['zones']):
+                if zone['master']:
+                    valve_desired |= 1 << i
+        self.schedule_status = new_schedule_status
+        return valve_desired, new_schedule_status
+
+
+def random_config(rng: random.Random, start: int, days: float) -> dict:
+    """Zones, schedules (some wrapping past midnight, disabled or expiring) and irrigation factor options"""
+    zones = [{"name": f"zone-{i}", "on_pin": i, "off_pin": i, "master": i == 0 and rng.random() < 0.5}
+             for i in range(rng.randint(1, 4))]
+    schedules = []
+    for _ in range(rng.randint(1, 6)):
+        start_sec = 86400 - rng.randint(1, 3600) if rng.random() < 0.3 else rng.randrange(86400)
+        schedules.append({
+            "zone_id": rng.randrange(len(zones)),
+            "start_sec": start_sec,
+            "duration_sec": rng.choice([1, 2, 3, 60, rng.randint(1, 7200)]),
+            "enable_irrigation_factor": rng.random() < 0.5,
+            "enabled": rng.random() < 0.9,
+            "expiry": start + rng.randrange(int(days * 86400)) if rng.random() < 0.2 else 0,
+        })
+    return {"zones": zones, "schedules": schedules, "options": {
+        "irrigation_factor": {
+            "reference_schedule_id": rng.randrange(-1, len(schedules)),
+            "soil_moisture_dry": rng.randint(200, 600),
+            "soil_moisture_wet": rng.randint(600, 900),
+            "override": rng.choice([-1, -1, -1, 0, 0.5, 1.5]),
+        },
+        "settings": {"enable_irrigation_schedule": rng.random() < 0.95},
+    }}
+
+
+def verify(configs: int, days: float, seed: int = 0) -> dict:
+    """Checks the event-driven scheduler against ReferenceScheduler on random configs and soil moisture, every second
+    of days: evaluate_schedules() must give the same valves and schedule_status, and its result may only change when
+    the scheduler wakes up after sec_till_next_transition(). While sampling the soil it polls every SCHEDULE_POLL_SEC
+    like the original loop, so changes in between are allowed."""
+    rng = random.Random(seed)
+    failures = []
+    checked = 0
+    for n in range(configs):
+        start = EPOCH_2000 + 24 * 365 * 86400 + rng.randrange(86400)
+        main = Simulator(random_config(rng, start, days), start - EPOCH_2000).main
+        reference = ReferenceScheduler(main.get_config())
+        soil = {"milli": None}
+        main.get_soil_moisture_milli = lambda raw_reading=None: soil['milli']
+        result = None
+        wake_at = start
+        polling = False
+        for t in range(start, start + int(days * 86400)):
+            if t % 600 == 0:
+                soil['milli'] = rng.choice([None, rng.randint(0, 1000), rng.randint(0, 1000)])
+            expected = reference.evaluate(t, soil['milli'])
+            previous_irrigation_factor = main.irrigation_factor
+            valve_desired, schedule_status, soil_moisture_polled = main.evaluate_schedules(t)
+            if main.irrigation_factor != previous_irrigation_factor:
+                main.build_schedule_timeline()
+            main.schedule_status = schedule_status
+            checked += 1
+            failure = None
+            if (valve_desired, schedule_status) != expected:
+                failure = "valves/schedule_status {:08b}/{:08b}, expected {:08b}/{:08b}".format(
+                    valve_desired, schedule_status, *expected)
+            elif (valve_desired, schedule_status) != result and t < wake_at and not polling:
+                failure = f"changed {wake_at - t}s before the scheduler wakes up"
+            if failure:
+                failures.append({"config": n, "sec_of_day": t % 86400, "failure": failure,
+                                 "config_json": main.get_config()})
+                break
+            result = (valve_desired, schedule_status)
+            if t >= wake_at:
+                wake_at = t + main.sec_till_next_transition(t)
+                polling = soil_moisture_polled
+                if polling:
+                    wake_at = min(wake_at, t + main.SCHEDULE_POLL_SEC)
+    return {"configs": configs, "simulated_days": days, "seconds_checked": checked, "failures": failures}
+
+
+def format_transition(transition: tuple) -> str:
+    local_timestamp, old_status, new_status = transition
+    return f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(local_timestamp))} {old_status:08b} -> {new_status:08b}"
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', help='config.json to simulate (default: built-in demo config)')
+    parser.add_argument('--days', type=float, default=7)
+    parser.add_argument('--soil', help='soil model as dry_per_hour,wet_per_hour in milli units, or a daily curve as '
+                                       'sec_of_day:milli,sec_of_day:milli,...')
+    parser.add_argument('--bench', action='store_true', help='report simulated-days-per-second and allocations')
+    parser.add_argument('--power-save', action='store_true', help='report the light-sleep duty cycle without WiFi')
+    parser.add_argument('--boot', action='store_true', help='report the boot timings after a power loss')
+    parser.add_argument('--verify', type=int, metavar='CONFIGS', help='check the scheduler against the original loop')
+    parser.add_argument('--seed', type=int, default=0, help='of the --verify configs')
+    parser.add_argument('--verbose', action='store_true', help="show main.py's output")
+    args = parser.parse_args(argv)
+
+    config = None
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    sim = Simulator(config)
+    if args.verbose:
+        sim.main.console_log_level = sim.main.LOG_DEBUG
+    if args.soil and ':' in args.soil:
+        sim.soil_script([tuple(float(value) for value in point.split(':')) for point in args.soil.split(',')])
+    elif args.soil:
+        sim.soil_model(*[float(rate) for rate in args.soil.split(',')])
+
+    if args.verify:
+        report = verify(args.verify, args.days, args.seed)
+        print(json.dumps(report, indent=2))
+        sys.exit(1 if report['failures'] else 0)
+    if args.power_save:
+        print(json.dumps(power_report(config, args.days), indent=2))
+    elif args.boot:
+        print(json.dumps(sim.boot(), indent=2))
+    elif args.bench:
+        print(json.dumps(sim.bench(args.days), indent=2))
+    else:
+        sim.run(args.days * 86400)
+        for transition in sim.transitions:
+            print(format_transition(transition))
+    if args.verbose:
+        print(sim.output.getvalue())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Local stand-in for the ThingSpeak update API, point monitoring.thingsspeak_url at it.
+
+    python -m host.thingspeak --days 2 --outage 6,18   # simulated uploads with a WiFi outage from hour 6 to 18
+"""
+import argparse
+import asyncio
+import json
+import urllib.parse
+
+from host.simulator import Simulator, DEMO_CONFIG
+
+
+class ThingSpeak:
+    """Accepts /update and /channels/<id>/bulk_update.json, keeps every update in self.updates.
+    Set available to False to answer 503, delay to answer slowly."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        self.available = True
+        self.delay = 0.0
+        self.requests = []  # (method, path)
+        self.updates = []   # dicts with created_at and field1..field5
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, target, _ = (await reader.readline()).decode().split(' ', 2)
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                key, _, value = line.decode().partition(':')
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            self.requests.append((method, target))
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            status_code = self._update(method, target, body) if self.available else 503
+            writer.write(f'HTTP/1.0 {status_code} -\r\nContent-Length: 0\r\n\r\n'.encode())
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _update(self, method: str, target: str, body: bytes) -> int:
+        path, _, query = target.partition('?')
+        if method == 'GET' and path == '/update':
+            update = dict(urllib.parse.parse_qsl(query))
+            update.pop('api_key', None)
+            self.updates.append(update)
+            return 200
+        if method == 'POST' and path.startswith('/channels/') and path.endswith('/bulk_update.json'):
+            self.updates.extend(json.loads(body)['updates'])
+            return 202
+        return 404
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=float, default=1)
+    parser.add_argument('--outage', help='WiFi outage as start_hour,end_hour of the simulated run')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--channel-id', default='1', help="empty uses an /update request per sample")
+    args = parser.parse_args(argv)
+
+    thingspeak = ThingSpeak()
+    config = json.loads(json.dumps(DEMO_CONFIG))
+    config['options']['monitoring'] = {"thingsspeak_apikey": "KEY", "thingsspeak_channel_id": args.channel_id,
+                                       "batch_size": args.batch_size, "send_interval_sec": 300}
+    sim = Simulator(config)
+    sim.main.wlan.active(True)
+    sim.board.wifi_connected = True
+    outage = [float(hour) * 3600 for hour in args.outage.split(',')] if args.outage else None
+
+    async def network():
+        await thingspeak.start()
+        sim.main.config['options']['monitoring']['thingsspeak_url'] = thingspeak.url
+        if outage:
+            await asyncio.sleep(outage[0])
+            sim.board.wifi_available = False
+            await asyncio.sleep(outage[1] - outage[0])
+            sim.board.wifi_available = True
+        await asyncio.Event().wait()
+
+    sim.services.append(network)
+    sim.run(args.days * 86400, 'send_metrics')
+    status = sim.main.get_status()
+    print(json.dumps({
+        "updates": len(thingspeak.updates),
+        "requests": len(thingspeak.requests),
+        **{key: value for key, value in status.items() if key.startswith('metrics.')},
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,19 @@
 import network
 import utime as time
-from machine import Pin, ADC, PWM, reset, freq
+from machine import Pin, ADC, PWM, RTC, reset, freq, lightsleep, wake_reason, EXT0_WAKE
 import esp32
 import ujson
 import ntptime
 import uasyncio as asyncio
-import urequests as requests
 import gc
 import sys
+import struct
 from collections import namedtuple
-from uos import rename, stat
+from array import array
+from uos import rename, stat, remove, statvfs
+from binascii import hexlify
+from io import BytesIO
+import hashlib
 
 # Global variables
 micropython_to_timestamp: int = 3155673600 - 2208988800  # 1970-2000
@@ -20,14 +24,122 @@ valve_status: int = 0
 schedule_status: int = 0
 irrigation_factor: float = 1.0
 heartbeat_pin_id: int = -1
+button_pin_id: int = -1
 wifi_setup_mode = False
+MAX_ZONES: int = 32     # valve_status and schedule_status are bit masks, the per-zone arrays are sized by it
+HTTP_PORT: int = 80
+boot_first_tick_ms: int = None    # ticks_ms() of the first scheduler tick, i.e. since reset
 # id: str = ':'.join([f"{b:02X}" for b in wlan.config('mac')[3:]]) FIXME: memory allocation failed, no idea why
 
+#########
+# Logging
+#########
+# log() formats lazily: below log_level the message isn't built (up to 6 positional arguments, no tuple is
+# allocated). Log lines go to a preallocated ring buffer served at /log, and to the console from console_log_level.
+LOG_DEBUG: int = 10
+LOG_INFO: int = 20
+LOG_WARNING: int = 30
+LOG_ERROR: int = 40
+LOG_LEVELS: dict = {'debug': LOG_DEBUG, 'info': LOG_INFO, 'warning': LOG_WARNING, 'error': LOG_ERROR}
+LOG_LEVEL_NAMES: dict = {LOG_DEBUG: 'D', LOG_INFO: 'I', LOG_WARNING: 'W', LOG_ERROR: 'E'}
+LOG_BUFFER_BYTES: int = 8192
+log_buffer = bytearray(LOG_BUFFER_BYTES)
+log_written: int = 0    # bytes ever logged, the buffer holds the last LOG_BUFFER_BYTES of them
+log_level: int = LOG_INFO
+console_log_level: int = LOG_INFO
+log_appended = asyncio.Event()
+
+def log(level: int, message: str, a=None, b=None, c=None, d=None, e=None, f=None) -> None:
+    global log_written
+
+    if level < log_level and level < console_log_level:
+        return
+    line = f"@{time.time()} {LOG_LEVEL_NAMES[level]} {message.format(a, b, c, d, e, f)}"
+    if level >= console_log_level:
+        print(line)
+    if level < log_level:
+        return
+    data = (line + '\n').encode()[-LOG_BUFFER_BYTES:]
+    start = log_written % LOG_BUFFER_BYTES
+    head = min(len(data), LOG_BUFFER_BYTES - start)
+    log_buffer[start:start + head] = data[:head]
+    log_buffer[:len(data) - head] = data[head:]
+    log_written += len(data)
+    log_appended.set()
+    log_appended.clear()
+
+def write_log(writer, position: int) -> int:
+    """Writes the log from position (a log_written value) on, returns the new position"""
+    if log_written - position > LOG_BUFFER_BYTES:
+        if position:
+            writer.write(f"... {log_written - position - LOG_BUFFER_BYTES} bytes dropped\n")
+        position = log_written - LOG_BUFFER_BYTES
+    start, end = position % LOG_BUFFER_BYTES, log_written % LOG_BUFFER_BYTES
+    if position < log_written and start >= end:
+        writer.write(memoryview(log_buffer)[start:])
+        start = 0
+    writer.write(memoryview(log_buffer)[start:end])
+    return log_written
+
+async def stream_log(writer, follow: bool) -> None:
+    position = write_log(writer, 0)
+    await writer.drain()
+    while follow:
+        try:
+            await asyncio.wait_for(log_appended.wait(), SSE_KEEPALIVE_SEC)
+        except asyncio.TimeoutError:
+            # finds out about clients that are gone
+            writer.write('\n')
+        position = write_log(writer, position)
+        await writer.drain()
+
 # Persistent storage functions
 def save_as_json(filename: str, data: dict) -> None:
-    print(f"Saving data to {filename}")
-    with open(filename, 'w') as f:
+    log(LOG_INFO, "Saving data to {}", filename)
+    # write & rename, a power loss leaves either the old or the new file
+    with open(filename + '.tmp', 'w') as f:
         ujson.dump(data, f)
+    rename(filename + '.tmp', filename)
+
+# config.json writes are debounced: mark_config_dirty() after a change, persist_config() writes once no further
+# change arrived for CONFIG_SAVE_DELAY_SEC
+CONFIG_SAVE_DELAY_SEC: int = 5
+config_save_pending: bool = False
+config_changed = asyncio.Event()
+
+def mark_config_dirty() -> None:
+    global config_save_pending
+    config_save_pending = True
+    config_changed.set()
+
+def save_config() -> dict:
+    """Saves the config now, returns the saved document"""
+    global config_save_pending
+    saved_config = get_config()
+    save_as_json('config.json', saved_config)
+    config_save_pending = False
+    try:
+        save_config_cache()
+    except Exception as e:
+        log(LOG_ERROR, "Error saving {}: {}", CONFIG_CACHE_FILE, e)
+    return saved_config
+
+async def persist_config():
+    while True:
+        await config_changed.wait()
+        config_changed.clear()
+        expect_wake(WAKE_CONFIG, CONFIG_SAVE_DELAY_SEC)
+        try:
+            await asyncio.wait_for(config_changed.wait(), CONFIG_SAVE_DELAY_SEC)
+            continue # changed again, restart the delay
+        except asyncio.TimeoutError:
+            pass
+        expect_wake(WAKE_CONFIG, None)
+        if config_save_pending:
+            try:
+                save_config()
+            except Exception as e:
+                log(LOG_ERROR, "Error saving config: {}", e)
 
 def load_from_json(filename: str) -> dict:
     try:
@@ -44,28 +156,52 @@ async def connect_wifi() -> None:
             return
         network.hostname(config['options']['wifi']['hostname'])
         wlan.active(True)
-        print(f'@{time.time()} wifi connecting.', end='')
+        log(LOG_INFO, "wifi connecting to {}", config['options']['wifi']['ssid'])
         wlan.connect(config['options']['wifi']['ssid'], config['options']['wifi']['password'])
         for i in range(15):
             if wlan.isconnected():
                 break
             await asyncio.sleep(1)
-            print('.', end='')
         if wlan.isconnected():
-            print(f"connected, ip = {wlan.ifconfig()[0]}, hostname={config['options']['wifi']['hostname']}")
+            log(LOG_INFO, "wifi connected, ip = {}, hostname={}", wlan.ifconfig()[0], config['options']['wifi']['hostname'])
+            set_wifi_power_mode()
             return
         wlan.active(False)
-        print('network connection failed, retrying in 60 seconds')
+        log(LOG_WARNING, "wifi connection failed, retrying in 60 seconds")
     except Exception as e:
         wlan.active(False)
-        print(f"Exception while connecting to wifi: {e}")
+        log(LOG_ERROR, "Exception while connecting to wifi: {}", e)
 
 async def keep_wifi_connected():
+    retry_sec = WIFI_RETRY_SEC
     while True:
         while wlan.isconnected():
-            await asyncio.sleep(10)
-        await asyncio.sleep(60)
-        connect_wifi()
+            retry_sec = WIFI_RETRY_SEC
+            check_sec = 60 if config['options']['settings']['power_save'] else 10
+            expect_wake(WAKE_WIFI, check_sec)
+            await asyncio.sleep(check_sec)
+        expect_wake(WAKE_WIFI, retry_sec)
+        await asyncio.sleep(retry_sec)
+        await connect_wifi()
+        if wlan.isconnected():
+            await sync_ntp()
+        elif config['options']['settings']['power_save']:
+            # every attempt keeps the radio on for up to 15 seconds
+            retry_sec = min(2 * retry_sec, WIFI_RETRY_MAX_SEC)
+
+async def start_network(button_pin_id: int):
+    """Boot-time WiFi connection and first NTP sync, in the background of the scheduler and the server. Waits for the
+    setup button first: setup mode only runs the access point, station connections would disrupt its clients"""
+    if button_pin_id >= 0:
+        await wait_for_wifi_setup(button_pin_id, 1)
+    if wifi_setup_mode:
+        return
+    asyncio.create_task(keep_wifi_connected())
+    asyncio.create_task(periodic_ntp_sync())
+    asyncio.create_task(send_metrics())
+    await connect_wifi()
+    while wlan.isconnected() and clock_source != 'ntp' and not await sync_ntp():
+        await asyncio.sleep(10)
 
 # Time functions
 def get_local_timestamp() -> int:
@@ -75,160 +211,673 @@ def weekday(timestamp: int) -> int:
     # weekday is 0-6 for Mon-Sun.
     return ((timestamp or get_local_timestamp()) // 86400 + 3) % 7
 
+# Until NTP succeeds after a reset the clock is restored from the latest snapshot, an approximate time keeps the
+# schedules running without WiFi. RTC memory survives resets and deep sleep, CLOCK_FILE also survives a power loss
+# but is written less often to spare the flash.
+CLOCK_FILE = 'clock.bin'
+CLOCK_SNAPSHOT_SEC: int = 60
+CLOCK_FILE_SNAPSHOT_SEC: int = 3600
+clock_source: str = 'rtc'   # 'rtc' (kept by the RTC, or unset), 'snapshot' or 'ntp'
+
+def restore_clock() -> None:
+    global clock_source
+
+    snapshot = 0
+    try:
+        memory = RTC().memory()
+        if len(memory) == 4:
+            snapshot = struct.unpack('<I', memory)[0]
+    except Exception:
+        pass
+    try:
+        with open(CLOCK_FILE, 'rb') as f:
+            snapshot = max(snapshot, struct.unpack('<I', f.read(4))[0])
+    except Exception:
+        pass
+    if time.time() < snapshot:
+        t = time.gmtime(snapshot)
+        RTC().datetime((t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0))
+        clock_source = 'snapshot'
+        schedule_changed.set()
+    log(LOG_INFO, "clock source={}, UTC timestamp={}", clock_source, time.time()+micropython_to_timestamp)
+
+def save_clock_snapshot(to_flash: bool) -> None:
+    snapshot = struct.pack('<I', time.time())
+    RTC().memory(snapshot)
+    if to_flash:
+        with open(CLOCK_FILE, 'wb') as f:
+            f.write(snapshot)
+
+async def snapshot_clock():
+    count = 0
+    while True:
+        # in power_save manage_power() writes the RTC memory snapshot before every light sleep
+        power_save = config['options']['settings']['power_save']
+        interval = CLOCK_FILE_SNAPSHOT_SEC if power_save else CLOCK_SNAPSHOT_SEC
+        expect_wake(WAKE_CLOCK, interval)
+        await asyncio.sleep(interval)
+        count += 1
+        try:
+            save_clock_snapshot(power_save or count % (CLOCK_FILE_SNAPSHOT_SEC // CLOCK_SNAPSHOT_SEC) == 0)
+        except Exception as e:
+            log(LOG_ERROR, "Error saving the clock snapshot: {}", e)
+
 async def sync_ntp() -> bool:
+    global clock_source
     try:
         ntptime.settime()
-        print(f'@{time.time()} NTP synced, UTC time={time.time()+micropython_to_timestamp} Local time(GMT{config['options']['settings']['timezone_offset']:+})={time.time()+micropython_to_localtime}')
+        clock_source = 'ntp'
+        schedule_changed.set()
+        save_clock_snapshot(True)
+        log(LOG_INFO, "NTP synced, UTC time={} Local time(GMT{:+})={}", time.time()+micropython_to_timestamp, config['options']['settings']['timezone_offset'], time.time()+micropython_to_localtime)
         return True
     except:
-        print(f'@{time.time()} Error syncing time, current UTC timestamp={time.time()+micropython_to_timestamp}')
+        log(LOG_WARNING, "Error syncing time, current UTC timestamp={}", time.time()+micropython_to_timestamp)
         return False
 
 async def periodic_ntp_sync():
     while True:
+        expect_wake(WAKE_NTP, 24 * 60 * 60)
         await asyncio.sleep(24 * 60 * 60)  # 24 hours, assuming we are already synced
         while not await sync_ntp():
+            # without WiFi keep_wifi_connected() syncs once it's back
+            if not wlan.isconnected():
+                break
+            expect_wake(WAKE_NTP, 10)
             await asyncio.sleep(10) # 10 seconds
 
 # Watering control functions
-def control_watering(zone_id: int, start: bool) -> None:
+# Valves are actuated in batches: zones that share no pin (independent H-Bridge channels) are pulsed together,
+# up to max_parallel_pulses at a time, all within a single power-up of the main relay
+VALVE_PULSE_SEC: float = 0.060
+VALVE_SETTLE_SEC: float = 0.050
+RELAY_WARMUP_SEC: float = 0.250
+zone_pins: list = []    # (on Pin, off Pin) per zone, None for pin_id<0
+relay_pin: Pin = None
+valve_lock = asyncio.Lock()
+
+def build_zone_pins() -> None:
+    global zone_pins
+    global relay_pin
+
+    # Pin(pin_id) without a mode doesn't reconfigure the pin
+    zone_pins = [(Pin(zone['on_pin']) if zone['on_pin'] >= 0 else None,
+                  Pin(zone['off_pin']) if zone['off_pin'] >= 0 else None) for zone in config['zones']]
+    relay_pin_id = config['options']['settings']['relay_pin_id']
+    relay_pin = Pin(relay_pin_id) if relay_pin_id >= 0 else None
+
+def control_watering(zone_id: int, start: bool) -> Pin:
+    """Drives the zone's pin, returns the pin to release after VALVE_PULSE_SEC if the valve is latching"""
     if zone_id < 0 or zone_id >= len(config["zones"]):
-        print(f"Zone {zone_id} not found")
-        return
+        log(LOG_ERROR, "Zone {} not found", zone_id)
+        return None
     zone = config["zones"][zone_id]
-    pin_id = zone['on_pin'] if start else zone['off_pin']
-    if pin_id < 0:
-        print("NOP pin_id<0")
-        return
+    pin = zone_pins[zone_id][0 if start else 1]
+    if pin is None:
+        log(LOG_DEBUG, "NOP pin_id<0")
+        return None
     pin_value = 1 if zone['active_is_high'] else 0
-    print(f"Zones[{zone_id}]='{zone['name']}' (off_pin={zone['off_pin']}, on_pin={zone['on_pin']}) will be set {'open' if start else 'close'} using pin_id({pin_id}).value({pin_value})")
+    log(LOG_DEBUG, "Zones[{}]='{}' will be set {} using {}.value({})", zone_id, zone['name'], 'open' if start else 'close', pin, pin_value)
     if zone['on_pin'] == zone['off_pin']:
         # leave the pin in the state
         if start:
-            Pin(pin_id, Pin.OUT, value=pin_value)
+            pin.init(Pin.OUT, value=pin_value)
         else:
-            Pin(pin_id, Pin.IN)
-    else:
-        # pulse the pin
-        Pin(pin_id, Pin.OUT).value(pin_value)
-        time.sleep(0.060)
-        Pin(pin_id, Pin.IN)
+            pin.init(Pin.IN)
+        return None
+    # pulse the pin
+    pin.init(Pin.OUT, value=pin_value)
+    return pin
+
+def valve_batches(changed: int, new_status: int) -> list:
+    """Groups the changed zones into batches of zones with disjoint pins, masters open first and close last"""
+    zones = config['zones']
+    max_parallel = max(1, config['options']['settings']['max_parallel_pulses'])
+    batches = []
+    for phase in range(3):
+        # 0: masters opening, 1: other zones, 2: masters closing
+        batch, batch_pins = [], set()
+        for i, zone in enumerate(zones):
+            if not changed >> i & 1:
+                continue
+            if phase != (1 if not zone['master'] else 0 if new_status >> i & 1 else 2):
+                continue
+            pins = {zone['on_pin'], zone['off_pin']} - {-1}
+            if batch and (len(batch) >= max_parallel or batch_pins & pins):
+                batches.append(batch)
+                batch, batch_pins = [], set()
+            batch.append(i)
+            batch_pins |= pins
+        if batch:
+            batches.append(batch)
+    return batches
 
 async def apply_valves(new_status: int) -> None:
     global valve_status
-    if new_status == valve_status:
-        return
-
-    print(f"@{time.time()} apply_valves({new_status:08b}), valve_status={valve_status:08b}")
-    relay_pin_id = config['options']['settings']['relay_pin_id']
-    if relay_pin_id >= 0:
-        relay_value = 1 if config['options']['settings']['relay_active_is_high'] else 0
-        Pin(relay_pin_id, Pin.OUT, value=relay_value)
-        await asyncio.sleep(0.250) # wait for H-Bridges to power up
 
-    for i in range(len(config['zones'])):
-        if (valve_status^new_status)>>i & 1:
-            control_watering(i, new_status>>i & 1)
-            await asyncio.sleep(0.050) # wait to settle down
-    valve_status = new_status
+    async with valve_lock:
+        if new_status == valve_status:
+            return
 
-    if relay_pin_id >= 0:
-        Pin(relay_pin_id, Pin.IN)
+        log(LOG_INFO, "apply_valves({:08b}), valve_status={:08b}", new_status, valve_status)
+        if relay_pin:
+            relay_value = 1 if config['options']['settings']['relay_active_is_high'] else 0
+            relay_pin.init(Pin.OUT, value=relay_value)
+            await asyncio.sleep(RELAY_WARMUP_SEC) # wait for H-Bridges to power up
+
+        started = time.ticks_us()
+        for batch in valve_batches(valve_status ^ new_status, new_status):
+            pulsed = [pin for i in batch if (pin := control_watering(i, new_status >> i & 1))]
+            if pulsed:
+                await asyncio.sleep(VALVE_PULSE_SEC)
+                for pin in pulsed:
+                    pin.init(Pin.IN)
+            await asyncio.sleep(VALVE_SETTLE_SEC) # wait to settle down
+        valve_status = new_status
+        observe(valve_transition_latency, time.ticks_diff(time.ticks_us(), started))
+
+        if relay_pin:
+            relay_pin.init(Pin.IN)
+    notify_status()
 
 ######################
 # Irrigation scheduler
 ######################
-async def schedule_irrigation():
-    global schedule_status
-    global irrigation_factor
-    irrigation_factor_expiration: int = 0
-
-    await asyncio.sleep(5)
+# The scheduler is event driven: schedule_timeline holds the sorted seconds-of-day at which the result of
+# evaluate_schedules() may change, the scheduler sleeps until the next one (or until schedule_changed is set)
+SCHEDULE_MAX_SLEEP_SEC: int = 3600
+SCHEDULE_POLL_SEC: int = 2
+schedule_timeline: list = []
+schedule_deadlines: list = []
+schedule_changed = asyncio.Event()
+irrigation_factor_expiration: int = 0
+# With a cap on concurrent valves (settings.max_concurrent_valves) or on the summed weights of the open zones
+# (settings.max_concurrent_weight), overlapping schedules are queued: a schedule joins the queue at its start_sec,
+# waits until its zone fits in and then runs its full (irrigation_factor scaled) duration. The longest waiting
+# schedule starts first (longest-processing-time first keeps the total time short), shorter ones fill the remaining
+# capacity. A zone that's already open takes more schedules for free, a zone heavier than the cap runs alone.
+QUEUE_IDLE: int = 0
+QUEUE_WAITING: int = 1
+QUEUE_RUNNING: int = 2
+queue_state = bytearray()
+queue_since = array('L')    # local timestamp a schedule joined the queue (waiting) or started (running)
+queue_evaluated_at: int = 0
+queue_wake_at: int = 0      # local timestamp the first running schedule ends
+# Manual runs (POST /zone/<id>/run?duration=) open a zone on top of the schedules until manual_until, a stop
+# (POST /zone/<id>/stop) ends a manual run and closes the zone while its current schedules would keep it open.
+# They only live in memory: they survive config changes, not a reset. Manual runs count against the queue's caps: a
+# run that doesn't fit next to the open zones is refused, queued schedules wait for the manual runs to end.
+MANUAL_MAX_SEC: int = 86400
+manual_open: int = 0        # zones opened by a manual run
+manual_closed: int = 0      # zones stopped while scheduled
+manual_until = array('L', [0] * MAX_ZONES)  # local timestamp the manual run of a zone ends, indexed by zone_id
+manual_wake_at: int = 0     # local timestamp the first manual run ends
+
+def build_schedule_timeline() -> None:
+    global schedule_timeline
+    global schedule_deadlines
+    global queue_state
+    global queue_since
+    global queue_evaluated_at
+
+    timeline = set()
+    deadlines = []
+    for i in range(len(compiled.flags)):
+        if not compiled.flags[i] & SCHEDULE_ENABLED:
+            continue
+        # a schedule is active while 0 < (local_timestamp - start_sec) % 86400 <= duration_sec
+        start_sec = compiled.start_sec[i]
+        duration_sec = compiled.duration_sec[i]
+        timeline.add((start_sec + 1) % 86400)
+        timeline.add((start_sec + duration_sec + 1) % 86400)
+        if compiled.flags[i] & SCHEDULE_IRRIGATION_FACTOR:
+            timeline.add((start_sec + int(scaled_duration_sec(duration_sec)) + 1) % 86400)
+        if compiled.expiry[i]:
+            deadlines.append(compiled.expiry[i] + 1)
+    schedule_timeline = sorted(timeline)
+    schedule_deadlines = deadlines
+    # the queue survives changes that keep the schedules (e.g. PATCHed durations or a new irrigation_factor)
+    if len(queue_state) != len(compiled.flags) or not compiled.queue_enabled:
+        queue_state = bytearray(len(compiled.flags))
+        queue_since = array('L', [0] * len(compiled.flags))
+        queue_evaluated_at = 0
+
+def sec_till_next_transition(local_timestamp: int) -> int:
+    sec_of_day = local_timestamp % 86400
+    next_sec = SCHEDULE_MAX_SLEEP_SEC
+    if schedule_timeline:
+        next_sec = 86400 - sec_of_day + schedule_timeline[0]
+        for t in schedule_timeline:
+            if t > sec_of_day:
+                next_sec = t - sec_of_day
+                break
+    for deadline in schedule_deadlines + [irrigation_factor_expiration + 1, queue_wake_at, manual_wake_at]:
+        if deadline > local_timestamp:
+            next_sec = min(next_sec, deadline - local_timestamp)
+    return min(next_sec, SCHEDULE_MAX_SLEEP_SEC)
+
+def scaled_duration_sec(duration_sec: int) -> float:
+    # a wet reference schedule sets irrigation_factor = sec_since_start / duration_sec, rounding keeps its product
+    # at sec_since_start (e.g. 3573 * (967 / 3573) is 966.9999...) so the zone doesn't stop a second early
+    return round(duration_sec * irrigation_factor, 3)
+
+def schedule_need_sec(i: int) -> float:
+    if compiled.flags[i] & SCHEDULE_IRRIGATION_FACTOR:
+        return scaled_duration_sec(compiled.duration_sec[i])
+    return compiled.duration_sec[i]
+
+def dispatch_zone_queue(state, since, timestamp: int, manual: int = 0) -> None:
+    """Starts the waiting schedules of state that fit next to the running ones (and the manual zones) at timestamp,
+    longest first"""
+    cc = compiled
+    open_zones = manual
+    open_count = 0
+    open_weight = 0
+    for zone_id in range(len(config['zones']) if manual else 0):
+        if manual >> zone_id & 1:
+            open_count += 1
+            open_weight += cc.zone_weight[zone_id]
+    for i in range(len(state)):
+        if state[i] == QUEUE_RUNNING and not open_zones & (1 << cc.zone_id[i]):
+            open_zones |= 1 << cc.zone_id[i]
+            open_count += 1
+            open_weight += cc.zone_weight[cc.zone_id[i]]
     while True:
-        if heartbeat_pin_id > 0:
-            Pin(heartbeat_pin_id, Pin.OUT).on()
-
-        local_timestamp = get_local_timestamp()
-
-        if config['options']['irrigation_factor']['override'] >= 0:
-            irrigation_factor = config['options']['irrigation_factor']['override']
-        elif local_timestamp > irrigation_factor_expiration:
-            irrigation_factor = 1
-
-        valve_desired = 0
-        new_schedule_status = 0
-        for i, s in enumerate(config["schedules"]):
-            # print(f"@{time.time()} checking schedule={s}")
-            if not config['options']['settings']['enable_irrigation_schedule']:
+        best = -1
+        best_need = -1
+        for i in range(len(state)):
+            if state[i] != QUEUE_WAITING:
                 continue
-
-            if not s['enabled']:
+            zone_id = cc.zone_id[i]
+            if not open_zones & (1 << zone_id) and open_count and (
+                    (cc.max_valves and open_count >= cc.max_valves) or
+                    (cc.max_weight and open_weight + cc.zone_weight[zone_id] > cc.max_weight)):
                 continue
-
-            if s['expiry'] and local_timestamp > s['expiry']:
+            if (need := schedule_need_sec(i)) > best_need:
+                best, best_need = i, need
+        if best < 0:
+            return
+        state[best] = QUEUE_RUNNING
+        since[best] = timestamp
+        zone_id = cc.zone_id[best]
+        if not open_zones & (1 << zone_id):
+            open_zones |= 1 << zone_id
+            open_count += 1
+            open_weight += cc.zone_weight[zone_id]
+
+def update_zone_queue(local_timestamp: int) -> None:
+    """Queues the schedules whose start_sec passed since the previous update, retires the ones that ran their
+    duration and starts waiting ones"""
+    global queue_evaluated_at
+    global queue_wake_at
+
+    cc = compiled
+    elapsed = local_timestamp - queue_evaluated_at
+    # after a reset or a clock change the queue is rebuilt assuming the schedules ran at their start_sec, the ones
+    # that fit under the caps carry on where they were, the others wait (a brownout reset mustn't open them all)
+    resume = not 0 <= elapsed < 86400
+    resumed = []
+    for i in range(len(cc.flags)):
+        if not cc.schedule_enabled or not cc.flags[i] & SCHEDULE_ENABLED or (cc.expiry[i] and local_timestamp > cc.expiry[i]):
+            queue_state[i] = QUEUE_IDLE
+            continue
+        need = schedule_need_sec(i)
+        if queue_state[i] == QUEUE_RUNNING and local_timestamp - queue_since[i] >= need:
+            queue_state[i] = QUEUE_IDLE
+        if queue_state[i] == QUEUE_IDLE and need > 0:
+            sec_since_start = (local_timestamp - cc.start_sec[i]) % 86400
+            if resume and 0 < sec_since_start < need:
+                queue_state[i] = QUEUE_WAITING
+                queue_since[i] = local_timestamp - sec_since_start
+                resumed.append((i, queue_since[i]))
+            elif not resume and 0 < sec_since_start <= elapsed:
+                queue_state[i] = QUEUE_WAITING
+                queue_since[i] = local_timestamp - sec_since_start
+    dispatch_zone_queue(queue_state, queue_since, local_timestamp, manual_open)
+    for i, started in resumed:
+        if queue_state[i] == QUEUE_RUNNING:
+            queue_since[i] = started
+    queue_wake_at = 0
+    for i in range(len(queue_state)):
+        if queue_state[i] == QUEUE_RUNNING:
+            need = schedule_need_sec(i)
+            end = queue_since[i] + int(need)
+            if end - queue_since[i] < need:
+                end += 1
+            queue_wake_at = end if not queue_wake_at else min(queue_wake_at, end)
+    queue_evaluated_at = local_timestamp
+
+def zone_queue(local_timestamp: int) -> list:
+    """The running and waiting schedules with their (projected, ignoring manual runs) start and end local
+    timestamps, for /status"""
+    state = bytearray(queue_state)
+    since = array('L', queue_since)
+    t = local_timestamp
+    while QUEUE_WAITING in state:
+        dispatch_zone_queue(state, since, t)
+        # move on to the end of the first running schedule
+        ends = [since[i] + int(schedule_need_sec(i)) for i in range(len(state)) if state[i] == QUEUE_RUNNING]
+        t = max(t, min(ends))
+        for i in range(len(state)):
+            if state[i] == QUEUE_RUNNING and since[i] + int(schedule_need_sec(i)) <= t:
+                state[i] = QUEUE_IDLE
+    return [{
+        "schedule_id": i,
+        "zone_id": compiled.zone_id[i],
+        "state": 'running' if queue_state[i] == QUEUE_RUNNING else 'waiting',
+        "start": since[i],
+        "end": since[i] + int(schedule_need_sec(i)),
+    } for i in range(len(queue_state)) if queue_state[i] != QUEUE_IDLE]
+
+def manual_run_fits(zone_id: int) -> bool:
+    """True if zone_id can open next to the running schedules and manual runs within the queue's caps"""
+    cc = compiled
+    if not cc.queue_enabled:
+        return True
+    expire_manual_runs(get_local_timestamp())
+    open_zones = manual_open
+    for i in range(len(queue_state)):
+        if queue_state[i] == QUEUE_RUNNING:
+            open_zones |= 1 << cc.zone_id[i]
+    if open_zones >> zone_id & 1:
+        return True
+    open_count = 0
+    open_weight = 0
+    for i in range(len(config['zones'])):
+        if open_zones >> i & 1:
+            open_count += 1
+            open_weight += cc.zone_weight[i]
+    # like a schedule, a zone heavier than the cap runs alone
+    return not open_count or not ((cc.max_valves and open_count >= cc.max_valves) or
+                                  (cc.max_weight and open_weight + cc.zone_weight[zone_id] > cc.max_weight))
+
+def run_zone(zone_id: int, duration_sec: int) -> None:
+    global manual_open
+    global manual_closed
+
+    manual_open |= 1 << zone_id
+    manual_closed &= ~(1 << zone_id)
+    manual_until[zone_id] = get_local_timestamp() + duration_sec
+    log(LOG_INFO, "manual run of zone {} for {}s", zone_id, duration_sec)
+    schedule_changed.set()
+    notify_status()
+
+def stop_zone(zone_id: int) -> None:
+    global manual_open
+    global manual_closed
+
+    manual_open &= ~(1 << zone_id)
+    manual_closed |= 1 << zone_id
+    # the queue moves on to the waiting schedules
+    for i in range(len(queue_state)):
+        if queue_state[i] == QUEUE_RUNNING and compiled.zone_id[i] == zone_id:
+            queue_state[i] = QUEUE_IDLE
+    log(LOG_INFO, "manual stop of zone {}", zone_id)
+    schedule_changed.set()
+    notify_status()
+
+def expire_manual_runs(local_timestamp: int) -> None:
+    global manual_open
+    global manual_wake_at
+
+    manual_open &= (1 << len(config['zones'])) - 1
+    manual_wake_at = 0
+    for zone_id in range(len(config['zones']) if manual_open else 0):
+        if not manual_open >> zone_id & 1:
+            continue
+        if local_timestamp >= manual_until[zone_id]:
+            manual_open &= ~(1 << zone_id)
+        elif not manual_wake_at or manual_until[zone_id] < manual_wake_at:
+            manual_wake_at = manual_until[zone_id]
+
+def zone_overrides() -> list:
+    """The manual runs and stops, for /status"""
+    return [{"zone_id": zone_id, "state": 'run', "end": manual_until[zone_id]} if manual_open >> zone_id & 1 else
+            {"zone_id": zone_id, "state": 'stop'}
+            for zone_id in range(len(config['zones'])) if (manual_open | manual_closed) >> zone_id & 1]
+
+def evaluate_schedules(local_timestamp: int) -> tuple:
+    """Returns (valve_desired, schedule_status, soil_moisture_polled) at local_timestamp"""
+    global irrigation_factor
+    global irrigation_factor_expiration
+    global queue_wake_at
+    global manual_closed
+
+    cc = compiled
+    flags = cc.flags
+    soil_moisture_polled = False
+    expire_manual_runs(local_timestamp)
+    if cc.factor_override >= 0:
+        irrigation_factor = cc.factor_override
+    elif local_timestamp > irrigation_factor_expiration:
+        irrigation_factor = 1
+    if cc.queue_enabled:
+        update_zone_queue(local_timestamp)
+
+    valve_desired = 0
+    new_schedule_status = 0
+    for i in range(len(flags) if cc.schedule_enabled else 0):
+        # print(f"@{time.time()} checking schedule={i}")
+        if not flags[i] & SCHEDULE_ENABLED:
+            continue
+
+        if cc.expiry[i] and local_timestamp > cc.expiry[i]:
+            continue
+
+        # TODO: check week days
+        # weekday_start = weekday(local_timestamp+sec_till_start) + 6 % 7
+        # if ~s['day_mask'] & (1 << weekday()):
+        #     continue
+        # FIXME %86400 assumes the schedule is within a day, this isn't true for non daily schedules
+
+        duration_sec = cc.duration_sec[i]
+        if cc.queue_enabled:
+            if queue_state[i] != QUEUE_RUNNING:
                 continue
-
-            # TODO: check week days
-            # weekday_start = weekday(local_timestamp+sec_till_start) + 6 % 7
-            # if ~s['day_mask'] & (1 << weekday()):
-            #     continue
-            # FIXME %86400 assumes the schedule is within a day, this isn't true for non daily schedules
-
-            sec_till_start = (86400 + s['start_sec'] - local_timestamp % 86400) % 86400
-            duration_sec = round(s['duration_sec'])
-            sec_till_end = (sec_till_start + duration_sec) % 86400
-            if sec_till_end >= sec_till_start:
+            sec_since_start = local_timestamp - queue_since[i]
+        else:
+            sec_since_start = (local_timestamp - cc.start_sec[i]) % 86400
+            if not 0 < sec_since_start <= duration_sec:
                 # we are not inside the schedule
                 continue
+        sec_till_start = 86400 - sec_since_start
+        sec_till_end = duration_sec - sec_since_start
+
+        if cc.reference_schedule_id == i and irrigation_factor_expiration <= local_timestamp + sec_till_end:
+            # it's the reference_schedule_id and irrigation_factor is about to expire, we might need to adjust the irrigation factor
+            # keep polling without a reading too, the sensor may come back inside the window
+            soil_moisture_polled = True
+            soil_moisture = get_soil_moisture_milli()
+            if soil_moisture is None:
+                pass
+            elif schedule_status & (1 << i):
+                # reference_schedule_id is active, check if we should stop
+                if soil_moisture >= cc.soil_moisture_wet:
+                    irrigation_factor = sec_since_start / duration_sec
+                    irrigation_factor_expiration = local_timestamp + sec_till_start + duration_sec
+            else:
+                # reference_schedule_id is about to start, is it dry enough?
+                if soil_moisture >= cc.soil_moisture_dry:
+                    irrigation_factor = 0
+                    irrigation_factor_expiration = local_timestamp + sec_till_start + duration_sec
+
+        if flags[i] & SCHEDULE_IRRIGATION_FACTOR:
+            duration_sec = scaled_duration_sec(duration_sec)
+            # check if we are still inside the schedule (updated duration)
+            if cc.queue_enabled and sec_since_start >= duration_sec:
+                # done early, the next tick starts the waiting schedules
+                queue_state[i] = QUEUE_IDLE
+                queue_wake_at = local_timestamp + 1
+                continue
+            if sec_since_start > duration_sec:
+                continue
 
-            if (config['options']['irrigation_factor']['reference_schedule_id'] == i and
-                irrigation_factor_expiration <= local_timestamp + sec_till_end and
-                (soil_moisture := get_soil_moisture_milli()) is not None):
-                # it's the reference_schedule_id and irrigation_factor is about to expire, we might need to adjust the irrigation factor
-                if schedule_status & (1 << i):
-                    # reference_schedule_id is active, check if we should stop
-                    if soil_moisture >= config['options']['irrigation_factor']['soil_moisture_wet']:
-                        irrigation_factor = (local_timestamp - s['start_sec']) % 86400 / s['duration_sec']
-                        irrigation_factor_expiration = local_timestamp + sec_till_start + duration_sec
-                else:
-                    # reference_schedule_id is about to start, is it dry enough?
-                    if soil_moisture >= config['options']['irrigation_factor']['soil_moisture_dry']:
-                        irrigation_factor = 0
-                        irrigation_factor_expiration = local_timestamp + sec_till_start + duration_sec
-
-            if s['enable_irrigation_factor']:
-                duration_sec *= irrigation_factor
-                # check if we are still inside the schedule (updated duration)
-                sec_till_end = (sec_till_start + duration_sec) % 86400
-                if sec_till_end >= sec_till_start:
-                    continue
+        # we should irrigate, set the valve status
+        valve_desired |= (1 << cc.zone_id[i])
+        new_schedule_status |= (1 << i)
+        # print(f"@{time.time()} valve_desired={valve_desired:08b} for schedule={i}")
 
-            # we should irrigate, set the valve status
-            valve_desired |= (1 << s['zone_id'])
-            new_schedule_status |= (1 << i)
-            # print(f"@{time.time()} valve_desired={valve_desired:08b} for schedule={s}")
+    # print(f"@{time.time()} valve_desired={valve_desired:08b}")
+    # a stop lasts until the schedules close the zone anyway
+    manual_closed &= valve_desired
+    valve_desired = valve_desired & ~manual_closed | manual_open
+    if valve_desired > 0:
+        valve_desired |= cc.master_mask
 
-        # print(f"@{time.time()} valve_desired={valve_desired:08b}")
-        if valve_desired > 0:
-            for i, zone in enumerate(config["zones"]):
-                if zone['master']:
-                    valve_desired |= (1 << i)
+    return valve_desired, new_schedule_status, soil_moisture_polled
 
-        await apply_valves(valve_desired)
+async def schedule_tick() -> bool:
+    """Evaluates the schedules and drives the valves, returns True while the soil moisture is being sampled"""
+    global schedule_status
+    global boot_first_tick_ms
+
+    if heartbeat_pin_id > 0:
+        Pin(heartbeat_pin_id, Pin.OUT).on()
+
+    tick_started = time.ticks_us()
+    local_timestamp = get_local_timestamp()
+    schedule_changed.clear()
+    previous_irrigation_factor = irrigation_factor
+    valve_desired, new_schedule_status, soil_moisture_polled = evaluate_schedules(local_timestamp)
+    if irrigation_factor != previous_irrigation_factor:
+        build_schedule_timeline()
+
+    await apply_valves(valve_desired)
+    if schedule_status != new_schedule_status or irrigation_factor != previous_irrigation_factor:
         schedule_status = new_schedule_status
-        if heartbeat_pin_id > 0:
-            Pin(heartbeat_pin_id, Pin.IN)
-        await asyncio.sleep(2)
+        notify_status()
+    if heartbeat_pin_id > 0:
+        Pin(heartbeat_pin_id, Pin.IN)
+    observe(schedule_tick_latency, time.ticks_diff(time.ticks_us(), tick_started))
+    if boot_first_tick_ms is None:
+        boot_first_tick_ms = time.ticks_ms()
+        log(LOG_INFO, "first scheduler tick {}ms after reset", boot_first_tick_ms)
+    return soil_moisture_polled
+
+async def schedule_irrigation():
+    while True:
+        try:
+            soil_moisture_polled = await schedule_tick()
+        except Exception as e:
+            # a valve must not stay open because of a bug, retry on the next poll
+            log(LOG_ERROR, "Error in the scheduler, closing all valves: {}", e)
+            soil_moisture_polled = True
+            try:
+                await apply_valves(0)
+            except Exception as e:
+                log(LOG_ERROR, "Error closing the valves: {}", e)
+
+        # while the reference schedule is sampling the soil moisture, keep polling
+        sleep_sec = sec_till_next_transition(get_local_timestamp())
+        if soil_moisture_polled:
+            sleep_sec = min(sleep_sec, SCHEDULE_POLL_SEC)
+        wake_at = time.ticks_add(time.ticks_ms(), sleep_sec * 1000)
+        expect_wake(WAKE_SCHEDULER, sleep_sec)
+        try:
+            await asyncio.wait_for(schedule_changed.wait(), sleep_sec)
+        except asyncio.TimeoutError:
+            # how late the timer woke us up
+            observe(schedule_tick_jitter, max(0, time.ticks_diff(time.ticks_ms(), wake_at)) * 1000)
 
 #########################
 # Configuration functions
 #########################
+# config holds the normalized zones and options, the schedules only live in compiled (parallel arrays, one entry per
+# schedule), get_config() rebuilds the JSON form served by /config and stored in config.json
+SCHEDULE_ENABLED: int = 1
+SCHEDULE_IRRIGATION_FACTOR: int = 2
+
+class CompiledConfig:
+    """Hot-path form of the config: schedules as arrays and the per-tick settings resolved to attributes"""
+    __slots__ = ('zone_id', 'flags', 'start_sec', 'duration_sec', 'expiry', 'schedule_enabled', 'factor_override',
+                 'reference_schedule_id', 'soil_moisture_dry', 'soil_moisture_wet', 'master_mask', 'zone_weight',
+                 'max_valves', 'max_weight', 'queue_enabled')
+
+    def __init__(self):
+        self.zone_id = bytearray()
+        self.flags = bytearray()
+        self.start_sec = array('l')
+        self.duration_sec = array('l')
+        self.expiry = array('L')
+        self.schedule_enabled = False
+        self.factor_override = -1
+        self.reference_schedule_id = -1
+        self.soil_moisture_dry = 0
+        self.soil_moisture_wet = 0
+        self.master_mask = 0
+        self.zone_weight = array('f', [1.0] * MAX_ZONES)    # indexed by zone_id
+        self.max_valves = 0
+        self.max_weight = 0
+        self.queue_enabled = False
+
+    def add_schedule(self, schedule_data: dict) -> None:
+        """Normalizes and appends a schedule, raises ValueError/KeyError/TypeError if it's invalid"""
+        if not isinstance(schedule_data, dict):
+            raise ValueError(f'schedule must be an object: {schedule_data}')
+        # the original scheduler took start_sec modulo a day, configs may have it outside of 0..86399
+        start_sec = int(schedule_data['start_sec']) % 86400
+        duration_sec = int(schedule_data['duration_sec'])
+        expiry = int(schedule_data.get('expiry', 0))
+        if duration_sec < 0 or not 0 <= expiry <= 0xFFFFFFFF:
+            raise ValueError(f'invalid schedule: {schedule_data}')
+        self.zone_id.append(int(schedule_data['zone_id']))
+        self.flags.append((SCHEDULE_ENABLED if bool(schedule_data['enabled']) else 0) |
+                          (SCHEDULE_IRRIGATION_FACTOR if bool(schedule_data['enable_irrigation_factor']) else 0))
+        self.start_sec.append(start_sec)
+        self.duration_sec.append(duration_sec)
+        self.expiry.append(expiry)
+
+    def check_zones(self, zone_count: int) -> None:
+        for zone_id in self.zone_id:
+            if zone_id >= zone_count:
+                raise ValueError(f'schedule of zone {zone_id}, there are {zone_count} zones')
+
+    def resolve(self, normalized_config: dict) -> None:
+        options = normalized_config['options']
+        if len(normalized_config['zones']) > MAX_ZONES:
+            raise ValueError(f'more than {MAX_ZONES} zones')
+        self.check_zones(len(normalized_config['zones']))
+        self.schedule_enabled = options['settings']['enable_irrigation_schedule']
+        self.factor_override = options['irrigation_factor']['override']
+        self.reference_schedule_id = options['irrigation_factor']['reference_schedule_id']
+        self.soil_moisture_dry = options['irrigation_factor']['soil_moisture_dry']
+        self.soil_moisture_wet = options['irrigation_factor']['soil_moisture_wet']
+        self.master_mask = 0
+        for i, zone in enumerate(normalized_config['zones']):
+            if zone['master']:
+                self.master_mask |= (1 << i)
+            self.zone_weight[i] = zone['weight']
+        self.max_valves = options['settings']['max_concurrent_valves']
+        self.max_weight = options['settings']['max_concurrent_weight']
+        self.queue_enabled = self.max_valves > 0 or self.max_weight > 0
+        if self.reference_schedule_id >= 0:
+            self.flags[self.reference_schedule_id] |= SCHEDULE_IRRIGATION_FACTOR
+
+    def schedule(self, i: int) -> dict:
+        return {
+            "zone_id": self.zone_id[i],
+            "start_sec": self.start_sec[i],
+            "duration_sec": self.duration_sec[i],
+            "enable_irrigation_factor": bool(self.flags[i] & SCHEDULE_IRRIGATION_FACTOR),
+            "enabled": bool(self.flags[i] & SCHEDULE_ENABLED),
+            "expiry": self.expiry[i],
+        }
+
+compiled: CompiledConfig = CompiledConfig()
+
+def get_config() -> dict:
+    return {"zones": config['zones'], "schedules": [compiled.schedule(i) for i in range(len(compiled.flags))], "options": config['options']}
+
 def apply_config(new_config: dict) -> None:
     global config
+    global compiled
+    global valve_status
     global micropython_to_localtime
     global heartbeat_pin_id
+    global log_level
+    global console_log_level
 
-    normalized_config = {"zones": [], "schedules": [], "options": {}}
+    normalized_config = {"zones": [], "options": {}}
     for i, zone_data in enumerate(new_config.get('zones', [])):
         normalized_config['zones'].append({
             "name": str(zone_data.get('name', f'zone-{i}')),
@@ -236,16 +885,14 @@ def apply_config(new_config: dict) -> None:
             "active_is_high": bool(zone_data.get('active_is_high', True)),
             "on_pin": int(zone_data.get('on_pin', -1)),
             "off_pin": int(zone_data.get('off_pin', -1)),
+            "weight": float(zone_data.get('weight', 1)),
         })
-    for schedule_data in new_config.get('schedules', []):
-        normalized_config['schedules'].append({
-            "zone_id": int(schedule_data['zone_id']),
-            "start_sec": int(schedule_data['start_sec']),
-            "duration_sec": int(schedule_data['duration_sec']),
-            "enable_irrigation_factor": bool(schedule_data['enable_irrigation_factor']),
-            "enabled": bool(schedule_data['enabled']),
-            "expiry": int(schedule_data.get('expiry', 0)),
-        })
+    # read_config() delivers the schedules already compiled
+    new_compiled = new_config.get('schedules', [])
+    if not isinstance(new_compiled, CompiledConfig):
+        schedules, new_compiled = new_compiled, CompiledConfig()
+        for schedule_data in schedules:
+            new_compiled.add_schedule(schedule_data)
     bo = new_config.get('options', {})
     for key in ['wifi', 'irrigation_factor', 'monitoring', 'soil_moisture_sensor', 'settings']:
         bo.setdefault(key, {})
@@ -264,12 +911,19 @@ def apply_config(new_config: dict) -> None:
         "monitoring": {
             "thingsspeak_apikey": str(bo['monitoring'].get('thingsspeak_apikey', '')),
             "send_interval_sec": int(bo['monitoring'].get('send_interval_sec', 300)),
+            "batch_size": max(1, min(METRICS_BUFFER_SIZE, int(bo['monitoring'].get('batch_size', 4)))),
+            "thingsspeak_channel_id": str(bo['monitoring'].get('thingsspeak_channel_id', '')),
+            "thingsspeak_url": str(bo['monitoring'].get('thingsspeak_url', 'http://api.thingspeak.com')),
+            "history_interval_sec": int(bo['monitoring'].get('history_interval_sec', 60)),
         },
         "soil_moisture_sensor": {
             "adc_pin_id": int(bo['soil_moisture_sensor'].get('adc_pin_id', 12)),
             "power_pin_id": int(bo['soil_moisture_sensor'].get('power_pin_id', 13)),
             "high_is_dry": bool(bo['soil_moisture_sensor'].get('high_is_dry', True)),
             "sample_count": int(bo['soil_moisture_sensor'].get('sample_count', 3)),
+            "sample_interval_sec": int(bo['soil_moisture_sensor'].get('sample_interval_sec', 60)),
+            "filter": str(bo['soil_moisture_sensor'].get('filter', 'median')),
+            "filter_window": int(bo['soil_moisture_sensor'].get('filter_window', 5)),
         },
         "settings": {
             "enable_irrigation_schedule": bool(bo['settings'].get('enable_irrigation_schedule', True)),
@@ -277,30 +931,381 @@ def apply_config(new_config: dict) -> None:
             "relay_pin_id": int(bo['settings'].get('relay_pin_id', -1)),
             "heartbeat_pin_id": int(bo['settings'].get('heartbeat_pin_id', heartbeat_pin_id)),
             "relay_active_is_high": bool(bo['settings'].get('relay_active_is_high', False)),
+            "max_parallel_pulses": int(bo['settings'].get('max_parallel_pulses', 2)),
+            "max_concurrent_valves": int(bo['settings'].get('max_concurrent_valves', 0)),
+            "max_concurrent_weight": float(bo['settings'].get('max_concurrent_weight', 0)),
+            "upload_buffer_bytes": max(512, int(bo['settings'].get('upload_buffer_bytes', 4096))),
+            "power_save": bool(bo['settings'].get('power_save', False)),
+            "log_level": str(bo['settings'].get('log_level', 'info')),
+            "console_log_level": str(bo['settings'].get('console_log_level', 'warning')),
         },
     }
 
-    reference_schedule_id = normalized_config['options']['irrigation_factor']['reference_schedule_id']
-    if reference_schedule_id >= 0:
-        normalized_config['schedules'][reference_schedule_id]['enable_irrigation_factor'] = True
+    new_compiled.resolve(normalized_config)
     # print(f"apply_config({new_config})\n    normalized_config={normalized_config}")
 
-    # if zones changed, turn off all valves
-    if config and config.get('zones', []) != normalized_config['zones']:
-        apply_valves(0)
+    # samples of a differently configured sensor can't be compared
+    if config and config['options']['soil_moisture_sensor'] != normalized_config['options']['soil_moisture_sensor']:
+        reset_soil_moisture_samples()
 
+    zones_changed = config and config.get('zones', []) != normalized_config['zones']
     config = normalized_config
+    compiled = new_compiled
+    build_zone_pins()
+
+    # if zones changed, turn off all valves (of the new zones, as on boot)
+    if zones_changed:
+        valve_status = (1<<len(config['zones']))-1
+        asyncio.create_task(apply_valves(0))
 
     micropython_to_localtime = micropython_to_timestamp + round(config['options']['settings']['timezone_offset'] * 3600)
     heartbeat_pin_id = config['options']['settings']['heartbeat_pin_id']
+    log_level = LOG_LEVELS.get(config['options']['settings']['log_level'], LOG_INFO)
+    console_log_level = LOG_LEVELS.get(config['options']['settings']['console_log_level'], LOG_WARNING)
+    if wlan.isconnected():
+        set_wifi_power_mode()
+    build_schedule_timeline()
+    schedule_changed.set()
+
+# config.bin is config.json in a fast-load form: the normalized zones and options, followed by the compiled schedule
+# arrays as raw bytes, booting from it skips the schedule validation and the per-schedule dicts. It's valid while
+# config.json's size and mtime are the ones it was written for, e.g. an uploaded config.json makes it stale.
+CONFIG_CACHE_FILE = 'config.bin'
+CONFIG_CACHE_MAGIC = b'RSI1'
+CONFIG_CACHE_HEADER = '<4sHHII'  # magic, schedule count, JSON length, config.json size, config.json mtime
+CONFIG_CACHE_HEADER_BYTES = struct.calcsize(CONFIG_CACHE_HEADER)
+
+def config_file_stamp() -> tuple:
+    try:
+        file_stat = stat('config.json')
+        return file_stat[6], file_stat[8]
+    except OSError:
+        return 0, 0
+
+def save_config_cache() -> None:
+    size, mtime = config_file_stamp()
+    document = ujson.dumps({"zones": config['zones'], "options": config['options']}).encode()
+    with open(CONFIG_CACHE_FILE + '.tmp', 'wb') as f:
+        f.write(struct.pack(CONFIG_CACHE_HEADER, CONFIG_CACHE_MAGIC, len(compiled.flags), len(document), size, mtime))
+        f.write(document)
+        for values in (compiled.zone_id, compiled.flags, compiled.start_sec, compiled.duration_sec, compiled.expiry):
+            f.write(values)
+    rename(CONFIG_CACHE_FILE + '.tmp', CONFIG_CACHE_FILE)
+
+def load_config_cache() -> dict:
+    """Returns config.json's content from config.bin, with the schedules compiled, None if it's missing or stale"""
+    try:
+        with open(CONFIG_CACHE_FILE, 'rb') as f:
+            magic, count, length, size, mtime = struct.unpack(CONFIG_CACHE_HEADER, f.read(CONFIG_CACHE_HEADER_BYTES))
+            if magic != CONFIG_CACHE_MAGIC or (size, mtime) != config_file_stamp():
+                return None
+            document = ujson.loads(f.read(length))
+            schedules = CompiledConfig()
+            # the arrays are read in place, with the platform's item size, as they were written
+            schedules.zone_id = bytearray(count)
+            schedules.flags = bytearray(count)
+            schedules.start_sec = array('l', [0] * count)
+            schedules.duration_sec = array('l', [0] * count)
+            schedules.expiry = array('L', [0] * count)
+            for values, item_bytes in ((schedules.zone_id, 1), (schedules.flags, 1), (schedules.start_sec, struct.calcsize('l')),
+                                       (schedules.duration_sec, struct.calcsize('l')), (schedules.expiry, struct.calcsize('L'))):
+                if count and f.readinto(values) != count * item_bytes:
+                    return None
+            document['schedules'] = schedules
+            return document
+    except Exception:
+        return None
 
-def read_soil_moisture_raw() -> int:
+def load_config() -> None:
+    """Applies config.bin if it's up to date, otherwise config.json (and writes config.bin for the next boot). A config
+    that fails to apply is replaced by an empty one, the server and the setup access point still come up to fix it"""
+    started = time.ticks_us()
+    cached_config = load_config_cache()
+    try:
+        apply_config(cached_config or load_from_json('config.json') or {})
+    except Exception as e:
+        log(LOG_ERROR, "Error applying config.json, starting with an empty config: {}", e)
+        apply_config({})
+        return
+    log(LOG_INFO, "config loaded from {} in {}us", CONFIG_CACHE_FILE if cached_config else 'config.json', time.ticks_diff(time.ticks_us(), started))
+    if not cached_config and config_file_stamp()[0]:
+        try:
+            save_config_cache()
+        except Exception as e:
+            log(LOG_ERROR, "Error saving {}: {}", CONFIG_CACHE_FILE, e)
+
+#########################
+# Streaming config upload
+#########################
+# POST /config is parsed straight from the socket through a small buffer, schedules are compiled one by one as
+# they arrive, so the upload never exists as a whole in RAM (body, decoded string and parsed dicts)
+CONFIG_MAX_BYTES: int = 32768
+JSON_MAX_STRING: int = 128
+JSON_MAX_DEPTH: int = 4
+JSON_ESCAPES: dict = {ord('b'): 8, ord('f'): 12, ord('n'): 10, ord('r'): 13, ord('t'): 9}
+config_upload_peak_bytes: int = 0
+
+class JsonStreamReader:
+    """Incremental JSON parser over an HttpBody, raises ValueError on malformed or oversized input"""
+    def __init__(self, body, max_length: int):
+        self.body = body
+        self.buf = memoryview(bytearray(256))
+        self.pos = self.end = self.length = 0
+        self.max_length = max_length
+        self.mem_start = self.mem_peak = gc.mem_alloc()
+
+    def track_memory(self) -> None:
+        self.mem_peak = max(self.mem_peak, gc.mem_alloc())
+
+    async def _byte(self) -> int:
+        """Returns the next byte without consuming it, -1 at the end of the body"""
+        if self.pos >= self.end:
+            self.track_memory()
+            self.pos, self.end = 0, await self.body.readinto(self.buf)
+            self.length += self.end
+            if self.length > self.max_length:
+                raise ValueError(f'larger than {self.max_length} bytes')
+            if not self.end:
+                return -1
+        return self.buf[self.pos]
+
+    async def peek(self) -> int:
+        """Skips whitespace and returns the next byte"""
+        while (c := await self._byte()) in (0x20, 0x09, 0x0a, 0x0d):
+            self.pos += 1
+        return c
+
+    async def accept(self, c: int) -> bool:
+        if await self.peek() == c:
+            self.pos += 1
+            return True
+        return False
+
+    async def expect(self, c: int) -> None:
+        if not await self.accept(c):
+            raise ValueError(f"expected '{chr(c)}' at byte {self.length - self.end + self.pos}")
+
+    async def _hex4(self) -> int:
+        code = 0
+        for _ in range(4):
+            code = code * 16 + int(chr(await self._byte()), 16)
+            self.pos += 1
+        return code
+
+    async def string(self) -> str:
+        await self.expect(0x22)
+        s = bytearray()
+        while (c := await self._byte()) != 0x22:
+            if c < 0 or len(s) >= JSON_MAX_STRING:
+                raise ValueError('unterminated or too long string')
+            self.pos += 1
+            if c == 0x5c:
+                c = await self._byte()
+                self.pos += 1
+                if c == ord('u'):
+                    code = await self._hex4()
+                    if 0xd800 <= code < 0xdc00:
+                        # characters outside the BMP are escaped as a surrogate pair (json.dumps with ensure_ascii)
+                        for c in b'\\u':
+                            if await self._byte() != c:
+                                raise ValueError('unpaired surrogate')
+                            self.pos += 1
+                        low = await self._hex4()
+                        if not 0xdc00 <= low < 0xe000:
+                            raise ValueError('unpaired surrogate')
+                        code = 0x10000 + ((code - 0xd800) << 10) + (low - 0xdc00)
+                    elif 0xdc00 <= code < 0xe000:
+                        raise ValueError('unpaired surrogate')
+                    s.extend(chr(code).encode())
+                    continue
+                c = JSON_ESCAPES.get(c, c)
+            s.append(c)
+        self.pos += 1
+        return s.decode()
+
+    async def scalar(self):
+        s = bytearray()
+        while (c := await self._byte()) >= 0 and c in b'+-.0123456789Eaeflnrstu':
+            if len(s) >= 32:
+                raise ValueError('number too long')
+            s.append(c)
+            self.pos += 1
+        s = s.decode()
+        if s in ('true', 'false', 'null'):
+            return True if s == 'true' else False if s == 'false' else None
+        digits = s[1:] if s[:1] == '-' else s
+        if digits[:1] == '+' or digits[:1] == '0' and digits[1:2].isdigit():
+            raise ValueError(f'invalid number {s}')
+        return float(s) if '.' in s or 'e' in s or 'E' in s else int(s)
+
+    async def array(self, on_item, depth: int = 0) -> None:
+        await self.expect(ord('['))
+        if not await self.accept(ord(']')):
+            while True:
+                on_item(await self.value(depth + 1))
+                if not await self.accept(ord(',')):
+                    break
+            await self.expect(ord(']'))
+
+    async def value(self, depth: int = 0):
+        if depth > JSON_MAX_DEPTH:
+            raise ValueError('nested too deep')
+        c = await self.peek()
+        if c == ord('{'):
+            self.pos += 1
+            obj = {}
+            if not await self.accept(ord('}')):
+                while True:
+                    key = await self.string()
+                    await self.expect(ord(':'))
+                    obj[key] = await self.value(depth + 1)
+                    if not await self.accept(ord(',')):
+                        break
+                await self.expect(ord('}'))
+            return obj
+        if c == ord('['):
+            items = []
+            await self.array(items.append, depth)
+            return items
+        if c == 0x22:
+            return await self.string()
+        return await self.scalar()
+
+async def read_config(reader: JsonStreamReader) -> dict:
+    """Parses a config document, the schedules are returned as a CompiledConfig"""
+    new_config = {}
+    await reader.expect(ord('{'))
+    if not await reader.accept(ord('}')):
+        while True:
+            key = await reader.string()
+            await reader.expect(ord(':'))
+            if key == 'schedules':
+                new_config[key] = CompiledConfig()
+                await reader.array(new_config[key].add_schedule, 1)
+            else:
+                new_config[key] = await reader.value(1)
+            if not await reader.accept(ord(',')):
+                break
+        await reader.expect(ord('}'))
+    if await reader.peek() >= 0:
+        raise ValueError('trailing data after the config')
+    return new_config
+
+async def upload_config(body) -> dict:
+    """Reads, applies and saves a config upload, returns the normalized config"""
+    global config_upload_peak_bytes
+
+    if body.remaining > CONFIG_MAX_BYTES:
+        raise ValueError(f'larger than {CONFIG_MAX_BYTES} bytes')
+    reader = JsonStreamReader(body, CONFIG_MAX_BYTES)
+    new_config = await read_config(reader)
+    log(LOG_DEBUG, "applying new config = {}", new_config)
+    apply_config(new_config)
+    reader.track_memory()
+    config_upload_peak_bytes = reader.mem_peak - reader.mem_start
+    return save_config()
+
+############################
+# Incremental config updates
+############################
+# PATCH /config takes JSON Patch (RFC 6902) add/replace/remove operations. Patches that only replace schedule
+# fields are written into the compiled arrays in place, anything else patches the JSON form and re-applies it.
+def patch_schedules(operations: list) -> None:
+    patched = {}
+    for operation in operations:
+        _, _, i, field = operation['path'].split('/')
+        i = int(i)
+        if not 0 <= i < len(compiled.flags):
+            raise IndexError(f'no schedule {i}')
+        schedule = patched.get(i) or compiled.schedule(i)
+        if field not in schedule:
+            raise KeyError(field)
+        schedule[field] = operation['value']
+        patched[i] = schedule
+
+    # validate all the patched schedules before changing anything
+    validated = CompiledConfig()
+    for schedule in patched.values():
+        validated.add_schedule(schedule)
+    validated.check_zones(len(config['zones']))
+    for j, i in enumerate(patched):
+        compiled.zone_id[i] = validated.zone_id[j]
+        compiled.flags[i] = validated.flags[j]
+        compiled.start_sec[i] = validated.start_sec[j]
+        compiled.duration_sec[i] = validated.duration_sec[j]
+        compiled.expiry[i] = validated.expiry[j]
+    if 0 <= compiled.reference_schedule_id < len(compiled.flags):
+        compiled.flags[compiled.reference_schedule_id] |= SCHEDULE_IRRIGATION_FACTOR
+    build_schedule_timeline()
+    schedule_changed.set()
+
+def patch_document(document: dict, operation: dict) -> None:
+    keys = [key.replace('~1', '/').replace('~0', '~') for key in operation['path'].split('/')[1:]]
+    if not keys:
+        raise ValueError('use POST to replace the whole config')
+    parent = document
+    for key in keys[:-1]:
+        parent = parent[int(key)] if isinstance(parent, list) else parent[key]
+    op, key = operation['op'], keys[-1]
+    if isinstance(parent, list):
+        index = len(parent) if key == '-' else int(key)
+        if op == 'add':
+            parent.insert(index, operation['value'])
+        elif op == 'remove':
+            parent.pop(index)
+        else:
+            parent[index] = operation['value']
+    elif op == 'remove':
+        del parent[key]
+    elif op == 'replace' and key not in parent:
+        raise KeyError(key)
+    else:
+        parent[key] = operation['value']
+
+def patch_config(operations: list) -> None:
+    if not isinstance(operations, list):
+        raise ValueError('expected a list of operations')
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get('op') not in ('add', 'replace', 'remove') or not isinstance(operation.get('path'), str):
+            raise ValueError(f'invalid operation: {operation}')
+
+    if all(operation['op'] == 'replace' and operation['path'].startswith('/schedules/') and operation['path'].count('/') == 3 for operation in operations):
+        patch_schedules(operations)
+    else:
+        # get_config() shares the live zones and options, a rejected patch must leave them alone and apply_config()
+        # compares the zones with the old ones
+        document = ujson.loads(ujson.dumps(get_config()))
+        for operation in operations:
+            patch_document(document, operation)
+        apply_config(document)
+    mark_config_dirty()
+
+#######################
+# Soil moisture sampler
+#######################
+# sample_soil_moisture() is the only reader of the sensor, it stores raw readings in a preallocated ring buffer,
+# everyone else reads the latest filtered value with soil_moisture_raw()
+SOIL_MOISTURE_HISTORY_SIZE: int = 64
+SOIL_MOISTURE_FAST_INTERVAL_SEC: int = 2
+soil_moisture_samples = array('H', bytes(2 * SOIL_MOISTURE_HISTORY_SIZE))
+soil_moisture_sample_count: int = 0
+soil_moisture_filtered: int = None
+soil_moisture_sampled_at: int = 0
+
+def reset_soil_moisture_samples() -> None:
+    global soil_moisture_sample_count
+    global soil_moisture_filtered
+
+    soil_moisture_sample_count = 0
+    soil_moisture_filtered = None
+
+async def read_soil_moisture_raw() -> int:
     soil_moisture_config = config['options']['soil_moisture_sensor']
     if 0 > soil_moisture_config['adc_pin_id']:
         return None
     if soil_moisture_config['power_pin_id'] >= 0:
         Pin(soil_moisture_config['power_pin_id'], Pin.OUT).value(1)
-        time.sleep(0.010)
+        await asyncio.sleep_ms(10)
     # https://docs.micropython.org/en/latest/esp32/quickref.html#adc-analog-to-digital-conversion
     adc = ADC(soil_moisture_config['adc_pin_id'], atten=ADC.ATTN_11DB)
     raw_reading = 0
@@ -311,82 +1316,1011 @@ def read_soil_moisture_raw() -> int:
         Pin(soil_moisture_config['power_pin_id'], Pin.IN)
     return raw_reading
 
+def add_soil_moisture_sample(raw_reading: int) -> None:
+    global soil_moisture_sample_count
+    global soil_moisture_filtered
+    global soil_moisture_sampled_at
+
+    soil_moisture_config = config['options']['soil_moisture_sensor']
+    soil_moisture_samples[soil_moisture_sample_count % SOIL_MOISTURE_HISTORY_SIZE] = raw_reading
+    soil_moisture_sample_count += 1
+    soil_moisture_sampled_at = get_local_timestamp()
+
+    window = min(soil_moisture_config['filter_window'], soil_moisture_sample_count, SOIL_MOISTURE_HISTORY_SIZE)
+    if soil_moisture_config['filter'] == 'median' and window > 1:
+        recent = sorted([soil_moisture_samples[(soil_moisture_sample_count - 1 - i) % SOIL_MOISTURE_HISTORY_SIZE] for i in range(window)])
+        soil_moisture_filtered = recent[window // 2]
+    elif soil_moisture_config['filter'] == 'ema' and soil_moisture_filtered is not None:
+        # the smoothing factor of an N sample EMA is 2/(N+1)
+        soil_moisture_filtered = (soil_moisture_filtered * (window - 1) + raw_reading * 2) // (window + 1)
+    else:
+        soil_moisture_filtered = raw_reading
+
+async def sample_soil_moisture():
+    while True:
+        try:
+            if (raw_reading := await read_soil_moisture_raw()) is not None:
+                previous_milli = get_soil_moisture_milli()
+                add_soil_moisture_sample(raw_reading)
+                if get_soil_moisture_milli() != previous_milli:
+                    notify_status()
+        except Exception as e:
+            log(LOG_ERROR, "Error sampling soil moisture: {}", e)
+        # sample fast while the reference schedule is irrigating, it decides when the soil is wet enough
+        if compiled.reference_schedule_id >= 0 and schedule_status & (1 << compiled.reference_schedule_id):
+            interval = SOIL_MOISTURE_FAST_INTERVAL_SEC
+        else:
+            interval = config['options']['soil_moisture_sensor']['sample_interval_sec']
+        expect_wake(WAKE_SOIL, interval)
+        await asyncio.sleep(interval)
+
+def soil_moisture_raw() -> int:
+    """Latest filtered raw reading, None if there's no sensor or no sample yet"""
+    return soil_moisture_filtered if config['options']['soil_moisture_sensor']['adc_pin_id'] >= 0 else None
+
 def get_soil_moisture_milli(raw_reading: int = None) -> int:
     if raw_reading is None:
-        raw_reading = read_soil_moisture_raw()
+        raw_reading = soil_moisture_raw()
     if raw_reading is None:
         return None
     # raw range of [1..65534] is linarly mapped onto [1..999], 0->0, 65535->1000
     milli_moist = int((65.3+raw_reading) // 65.6)
     return 1000-milli_moist if config['options']['soil_moisture_sensor']['high_is_dry'] else milli_moist
 
+########
+# Status
+########
+# /events streams status changes as Server-Sent Events: the full status once, then only the fields of
+# STATUS_EVENT_FIELDS that changed, whenever notify_status() is called
+STATUS_EVENT_FIELDS: tuple = ('valve_status', 'schedule_status', 'irrigation_factor', 'soil_moisture_milli', 'overrides')
+SSE_KEEPALIVE_SEC: int = 30
+status_changed = asyncio.Event()
+
+def status_event_values() -> tuple:
+    """The current values of STATUS_EVENT_FIELDS, in the same order"""
+    return (f"{valve_status:08b}", f"{schedule_status:08b}", irrigation_factor, get_soil_moisture_milli(), zone_overrides())
+
+def get_status() -> dict:
+    raw_reading = soil_moisture_raw()
+    return {
+        "local_timestamp": get_local_timestamp(),
+        "soil_moisture_milli": get_soil_moisture_milli(raw_reading),
+        "soil_moisture_raw": raw_reading,
+        "soil_moisture_sampled_at": soil_moisture_sampled_at,
+        "config_upload_peak_bytes": config_upload_peak_bytes,
+        "metrics.uploads": metrics_uploads,
+        "metrics.upload_failures": metrics_upload_failures,
+        "metrics.upload_ms": metrics_upload_ms,
+        "metrics.upload_ms_max": metrics_upload_ms_max,
+        "metrics.spooled": metrics_spooled,
+        "metrics.dropped": metrics_dropped,
+        "gc.mem_alloc": gc.mem_alloc(),
+        "gc.mem_free": gc.mem_free(),
+        "valve_status": f"{valve_status:08b}",
+        "schedule_status": f"{schedule_status:08b}",
+        "mcu_temperature": esp32.mcu_temperature(),
+        "irrigation_factor": irrigation_factor,
+        "queue": zone_queue(get_local_timestamp()) if compiled.queue_enabled else [],
+        "overrides": zone_overrides(),
+        "hostname": config['options']['wifi']['hostname'],
+        "clock_source": clock_source,
+        "boot_first_tick_ms": boot_first_tick_ms,
+        "power.duty_cycle": power_duty_cycle(),
+        "power.wakes": power_wakes,
+        "power.slept_sec": power_slept_ms // 1000,
+        "power.cpu_hz": freq(),
+    }
+
+def notify_status() -> None:
+    # wakes up all the waiting streams
+    status_changed.set()
+    status_changed.clear()
+
+async def stream_status_events(writer) -> None:
+    status = get_status()
+    writer.write(f'data: {ujson.dumps(status)}\n\n')
+    await writer.drain()
+    sent = [status[field] for field in STATUS_EVENT_FIELDS]
+    while True:
+        try:
+            await asyncio.wait_for(status_changed.wait(), SSE_KEEPALIVE_SEC)
+        except asyncio.TimeoutError:
+            # a comment, finds out about clients that are gone
+            writer.write(': ping\n\n')
+            await writer.drain()
+            continue
+        current = status_event_values()
+        changed = {}
+        for i, field in enumerate(STATUS_EVENT_FIELDS):
+            if current[i] != sent[i]:
+                changed[field] = sent[i] = current[i]
+        if changed:
+            writer.write(f'data: {ujson.dumps(changed)}\n\n')
+            await writer.drain()
+
+#########
+# Metrics
+#########
+# send_metrics() takes a sample every send_interval_sec into a preallocated buffer and uploads batch_size samples at a
+# time with ThingSpeak's bulk update, over a non-blocking connection. Batches that can't be uploaded are appended to
+# METRICS_SPOOL_FILE and replayed, oldest first, before the next batch once uploads work again.
+# A record is the UTC timestamp followed by the 5 fields, the same layout in RAM and in the spool file.
+METRICS_RECORD: str = '<I5f'
+METRICS_RECORD_BYTES: int = struct.calcsize(METRICS_RECORD)
+METRICS_BUFFER_SIZE: int = 32
+METRICS_SPOOL_FILE: str = 'metrics.spool'
+METRICS_SPOOL_MAX_BYTES: int = 64 * 1024
+METRICS_UPLOAD_TIMEOUT_SEC: int = 10
+metrics_buffer = bytearray(METRICS_BUFFER_SIZE * METRICS_RECORD_BYTES)
+metrics_replay_buffer = bytearray(METRICS_BUFFER_SIZE * METRICS_RECORD_BYTES)
+metrics_count: int = 0
+metrics_spool_offset: int = 0  # bytes of the spool file already uploaded
+metrics_spooled: int = 0
+metrics_dropped: int = 0
+metrics_uploads: int = 0
+metrics_upload_failures: int = 0
+metrics_upload_ms: int = 0
+metrics_upload_ms_max: int = 0
+
+def add_metrics_sample() -> None:
+    global metrics_count
+
+    soil_moisture_milli = get_soil_moisture_milli()
+    struct.pack_into(METRICS_RECORD, metrics_buffer, metrics_count * METRICS_RECORD_BYTES, time.time(),
+        float('nan') if soil_moisture_milli is None else soil_moisture_milli,
+        gc.mem_alloc(), valve_status, irrigation_factor, esp32.mcu_temperature())
+    metrics_count += 1
+
+def metrics_update(buffer, i: int) -> dict:
+    record = struct.unpack_from(METRICS_RECORD, buffer, i * METRICS_RECORD_BYTES)
+    t = time.gmtime(record[0])
+    update = {"created_at": f"{t[0]}-{t[1]:02}-{t[2]:02}T{t[3]:02}:{t[4]:02}:{t[5]:02}Z"}
+    for field, value in enumerate(record[1:]):
+        if value == value: # NaN, no reading
+            value = round(value, 3)
+            update[f"field{field+1}"] = int(value) if value == int(value) else value
+    return update
+
+async def http_request(method: str, url: str, body: str = '') -> int:
+    """Minimal HTTP/1.0 client that doesn't block the event loop, returns the status code"""
+    host, _, path = url.split('://', 1)[-1].partition('/')
+    host, _, port = host.partition(':')
+    reader, writer = await asyncio.open_connection(host, int(port or 80))
+    try:
+        body = body.encode()
+        writer.write(f"{method} /{path} HTTP/1.0\r\nHost: {host}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode())
+        writer.write(body)
+        await writer.drain()
+        return int((await reader.readline()).split()[1])
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+async def upload_metrics(buffer, count: int) -> None:
+    global metrics_uploads
+    global metrics_upload_failures
+    global metrics_upload_ms
+    global metrics_upload_ms_max
+
+    monitoring = config['options']['monitoring']
+    start_time = time.ticks_ms()
+    try:
+        if monitoring['thingsspeak_channel_id']:
+            body = ujson.dumps({"write_api_key": monitoring['thingsspeak_apikey'], "updates": [metrics_update(buffer, i) for i in range(count)]})
+            http_requests = [('POST', f"{monitoring['thingsspeak_url']}/channels/{monitoring['thingsspeak_channel_id']}/bulk_update.json", body)]
+        else:
+            # the bulk update needs the channel id, fall back to an update per sample
+            http_requests = [('GET', f"{monitoring['thingsspeak_url']}/update?api_key={monitoring['thingsspeak_apikey']}&" + '&'.join([f'{k}={v}' for k, v in metrics_update(buffer, i).items()]), '')
+                        for i in range(count)]
+        for method, url, body in http_requests:
+            status_code = await asyncio.wait_for(http_request(method, url, body), METRICS_UPLOAD_TIMEOUT_SEC)
+            if not 200 <= status_code < 300:
+                raise OSError(f"HTTP {status_code}")
+    except:
+        metrics_upload_failures += 1
+        raise
+    metrics_uploads += 1
+    metrics_upload_ms = time.ticks_diff(time.ticks_ms(), start_time)
+    metrics_upload_ms_max = max(metrics_upload_ms_max, metrics_upload_ms)
+
+def metrics_spool_size() -> int:
+    try:
+        return stat(METRICS_SPOOL_FILE)[6]
+    except OSError:
+        return 0
+
+def spool_metrics() -> None:
+    global metrics_count
+    global metrics_spooled
+    global metrics_dropped
+
+    size = metrics_spool_size()
+    count = min(metrics_count, max(0, METRICS_SPOOL_MAX_BYTES - size) // METRICS_RECORD_BYTES)
+    spooled = 0
+    try:
+        if count:
+            with open(METRICS_SPOOL_FILE, 'ab') as f:
+                f.write(memoryview(metrics_buffer)[:count * METRICS_RECORD_BYTES])
+            spooled = count
+    finally:
+        # the buffer is emptied even when the flash is full or failing, the next sample must fit in
+        metrics_spooled = (size - metrics_spool_offset) // METRICS_RECORD_BYTES + spooled
+        metrics_dropped += metrics_count - spooled
+        metrics_count = 0
+
+async def replay_metrics_spool() -> None:
+    global metrics_spool_offset
+    global metrics_spooled
+
+    if not (size := metrics_spool_size()):
+        return
+    batch = memoryview(metrics_replay_buffer)[:config['options']['monitoring']['batch_size'] * METRICS_RECORD_BYTES]
+    with open(METRICS_SPOOL_FILE, 'rb') as f:
+        while metrics_spool_offset < size:
+            f.seek(metrics_spool_offset)
+            if not (count := f.readinto(batch) // METRICS_RECORD_BYTES):
+                break # a partially written record
+            await upload_metrics(batch, count)
+            metrics_spool_offset += count * METRICS_RECORD_BYTES
+            metrics_spooled = (size - metrics_spool_offset) // METRICS_RECORD_BYTES
+    remove(METRICS_SPOOL_FILE)
+    metrics_spool_offset = 0
+    metrics_spooled = 0
+
+async def flush_metrics() -> None:
+    global metrics_count
+
+    if wlan.isconnected():
+        try:
+            await replay_metrics_spool()
+            await upload_metrics(metrics_buffer, metrics_count)
+            metrics_count = 0
+            return
+        except Exception as e:
+            log(LOG_WARNING, "Error uploading metrics: {}", e)
+    spool_metrics()
+
+async def send_metrics():
+    global metrics_spooled
+
+    metrics_spooled = metrics_spool_size() // METRICS_RECORD_BYTES
+    while True:
+        try:
+            # TODO: add micropython.mem_info()
+            if config['options']['monitoring']['thingsspeak_apikey']:
+                add_metrics_sample()
+                if metrics_count >= config['options']['monitoring']['batch_size']:
+                    await flush_metrics()
+        except Exception as e:
+            log(LOG_ERROR, "Error sending metrics: {}", e)
+        finally:
+            expect_wake(WAKE_METRICS, config['options']['monitoring']['send_interval_sec'])
+            await asyncio.sleep(config['options']['monitoring']['send_interval_sec'])
+
+#########
+# History
+#########
+# HISTORY_FILE is a ring of HISTORY_BLOCKS preallocated blocks. A block starts with its sequence number and base
+# timestamp, followed by fixed-size records that hold the seconds since the base timestamp. Unwritten bytes are 0xFF,
+# like erased flash. history_seq and history_base index the blocks in RAM, /history only reads the blocks in range.
+HISTORY_FILE: str = 'history.bin'
+HISTORY_BLOCK_BYTES: int = 4096
+HISTORY_BLOCKS: int = 32
+HISTORY_HEADER: str = '<II'     # sequence number, base timestamp
+HISTORY_RECORD: str = '<HHBbH'  # seconds since base, soil_moisture_milli, valve_status, mcu_temperature, irrigation_factor*1000
+HISTORY_HEADER_BYTES: int = struct.calcsize(HISTORY_HEADER)
+HISTORY_RECORD_BYTES: int = struct.calcsize(HISTORY_RECORD)
+HISTORY_RECORDS_PER_BLOCK: int = (HISTORY_BLOCK_BYTES - HISTORY_HEADER_BYTES) // HISTORY_RECORD_BYTES
+HISTORY_FIELDS: tuple = ('timestamp', 'soil_moisture_milli', 'valve_status', 'irrigation_factor', 'mcu_temperature')
+HISTORY_MAX_POINTS: int = 300
+history_seq = array('I', [0xFFFFFFFF] * HISTORY_BLOCKS)
+history_base = array('I', [0xFFFFFFFF] * HISTORY_BLOCKS)
+history_block: int = -1     # the block being written
+history_records: int = 0    # records in history_block
+history_record = bytearray(HISTORY_RECORD_BYTES)
+
+def open_history() -> None:
+    global history_block
+    global history_records
+
+    history_block = -1
+    try:
+        if stat(HISTORY_FILE)[6] != HISTORY_BLOCKS * HISTORY_BLOCK_BYTES:
+            raise OSError('size')
+    except OSError:
+        with open(HISTORY_FILE, 'wb') as f:
+            erased = b'\xff' * HISTORY_BLOCK_BYTES
+            for _ in range(HISTORY_BLOCKS):
+                f.write(erased)
+        return
+    with open(HISTORY_FILE, 'rb') as f:
+        header = bytearray(HISTORY_HEADER_BYTES)
+        for block in range(HISTORY_BLOCKS):
+            f.seek(block * HISTORY_BLOCK_BYTES)
+            f.readinto(header)
+            history_seq[block], history_base[block] = struct.unpack(HISTORY_HEADER, header)
+            if history_seq[block] != 0xFFFFFFFF and (history_block < 0 or history_seq[block] > history_seq[history_block]):
+                history_block = block
+        if history_block < 0:
+            return
+        # records are appended in order, find the first unwritten one
+        low, high = 0, HISTORY_RECORDS_PER_BLOCK
+        while low < high:
+            middle = (low + high) // 2
+            f.seek(history_block * HISTORY_BLOCK_BYTES + HISTORY_HEADER_BYTES + middle * HISTORY_RECORD_BYTES)
+            f.readinto(history_record)
+            if history_record[0] == 0xFF and history_record[1] == 0xFF:
+                high = middle
+            else:
+                low = middle + 1
+        history_records = low
+
+def append_history(timestamp: int) -> None:
+    global history_block
+    global history_records
+
+    new_block = (history_block < 0 or history_records == HISTORY_RECORDS_PER_BLOCK
+                 or not 0 <= timestamp - history_base[history_block] < 0xFFFF)
+    if new_block:
+        # overwrites the oldest block
+        seq = 0 if history_block < 0 else history_seq[history_block] + 1
+        history_block = (history_block + 1) % HISTORY_BLOCKS
+        history_seq[history_block] = seq
+        history_base[history_block] = timestamp
+        history_records = 0
+    soil_moisture_milli = get_soil_moisture_milli()
+    struct.pack_into(HISTORY_RECORD, history_record, 0, timestamp - history_base[history_block],
+        0xFFFF if soil_moisture_milli is None else soil_moisture_milli, valve_status,
+        max(-128, min(127, round(esp32.mcu_temperature()))), max(0, min(0xFFFF, round(irrigation_factor * 1000))))
+    with open(HISTORY_FILE, 'r+b') as f:
+        offset = history_block * HISTORY_BLOCK_BYTES
+        if new_block:
+            # erase before the header, an interrupted erase leaves an empty block with its old header
+            f.seek(offset + HISTORY_HEADER_BYTES)
+            f.write(b'\xff' * (HISTORY_BLOCK_BYTES - HISTORY_HEADER_BYTES))
+            f.seek(offset)
+            f.write(struct.pack(HISTORY_HEADER, history_seq[history_block], timestamp))
+        f.seek(offset + HISTORY_HEADER_BYTES + history_records * HISTORY_RECORD_BYTES)
+        f.write(history_record)
+    history_records += 1
+
+async def record_history():
+    open_history()
+    recorded_valve_status = -1
+    while True:
+        interval = config['options']['monitoring']['history_interval_sec']
+        try:
+            if interval > 0:
+                append_history(time.time())
+                recorded_valve_status = valve_status
+        except Exception as e:
+            log(LOG_ERROR, "Error recording history: {}", e)
+        # valve transitions are recorded as they happen, everything else every history_interval_sec
+        interval = interval if interval > 0 else 60
+        deadline = time.time() + interval
+        while valve_status == recorded_valve_status and (remaining := min(deadline - time.time(), interval)) > 0:
+            expect_wake(WAKE_HISTORY, remaining)
+            try:
+                await asyncio.wait_for(status_changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+def history_row(timestamp: int, count: int, soil_sum: int, soil_count: int, valves: int, factor: int, temperature_sum: int) -> str:
+    return f'\n[{timestamp}, {soil_sum // soil_count if soil_count else "null"}, {valves}, {factor / 1000}, {round(temperature_sum / count, 1)}]'
+
+async def stream_history(writer, start: int, end: int, step: int) -> None:
+    """Writes the records between the UTC timestamps [start, end) averaged over step seconds, as JSON.
+    Soil moisture and temperature are averaged, valve_status is or-ed and irrigation_factor is the last one."""
+    writer.write(f'{{"fields": {ujson.dumps(HISTORY_FIELDS)}, "step": {step}, "data": [')
+    start -= micropython_to_timestamp
+    end -= micropython_to_timestamp
+    buffer = bytearray(64 * HISTORY_RECORD_BYTES)
+    bucket, count, soil_sum, soil_count, valves, factor, temperature_sum = -1, 0, 0, 0, 0, 0, 0
+    separator = ''
+    with open(HISTORY_FILE, 'rb') as f:
+        for i in range(1, HISTORY_BLOCKS + 1):
+            block = (history_block + i) % HISTORY_BLOCKS
+            base = history_base[block]
+            # a block holds less than 0xFFFF seconds
+            if history_seq[block] == 0xFFFFFFFF or base >= end or base + 0xFFFF <= start:
+                continue
+            records = history_records if block == history_block else HISTORY_RECORDS_PER_BLOCK
+            f.seek(block * HISTORY_BLOCK_BYTES + HISTORY_HEADER_BYTES)
+            while records > 0:
+                n = f.readinto(memoryview(buffer)[:min(records, 64) * HISTORY_RECORD_BYTES]) // HISTORY_RECORD_BYTES
+                if not n:
+                    break
+                records -= n
+                for j in range(n):
+                    delta, soil_moisture_milli, record_valves, temperature, record_factor = struct.unpack_from(HISTORY_RECORD, buffer, j * HISTORY_RECORD_BYTES)
+                    if delta == 0xFFFF:
+                        records = 0
+                        break
+                    timestamp = base + delta
+                    if not start <= timestamp < end:
+                        continue
+                    if (timestamp - start) // step != bucket:
+                        if count:
+                            writer.write(separator + history_row(start + bucket * step + micropython_to_timestamp, count, soil_sum, soil_count, valves, factor, temperature_sum))
+                            separator = ','
+                        bucket, count, soil_sum, soil_count, valves, temperature_sum = (timestamp - start) // step, 0, 0, 0, 0, 0
+                    count += 1
+                    if soil_moisture_milli != 0xFFFF:
+                        soil_sum += soil_moisture_milli
+                        soil_count += 1
+                    valves |= record_valves
+                    factor = record_factor
+                    temperature_sum += temperature
+                await writer.drain()
+    if count:
+        writer.write(separator + history_row(start + bucket * step + micropython_to_timestamp, count, soil_sum, soil_count, valves, factor, temperature_sum))
+    writer.write(']}\n')
+    await writer.drain()
+
+##################
+# Power management
+##################
+# With settings.power_save the board light-sleeps between events while the WiFi radio is off (no coverage, or between
+# reconnection attempts): a light sleep would drop the WiFi association, so while connected it relies on the WiFi
+# power-save mode instead, which still answers requests. Every periodic task tells expect_wake() when it needs to run
+# next, manage_power() sleeps until the earliest of them; a past wake-up means that task is running, nobody sleeps.
+# The setup button wakes the board up and keeps it awake (and reconnecting) for POWER_BUTTON_AWAKE_SEC.
+CPU_IDLE_HZ: int = 80_000_000
+CPU_BOOST_HZ: int = 160_000_000     # while serving requests in power_save, to get back to idle sooner
+WIFI_RETRY_SEC: int = 60
+WIFI_RETRY_MAX_SEC: int = 3600
+POWER_MIN_SLEEP_MS: int = 1000
+POWER_MAX_SLEEP_MS: int = 3600_000
+POWER_CHECK_MS: int = 10_000
+POWER_BUSY_CHECK_MS: int = 100
+POWER_BUTTON_AWAKE_SEC: int = 300
+WAKE_SCHEDULER, WAKE_SOIL, WAKE_METRICS, WAKE_HISTORY, WAKE_WIFI, WAKE_NTP, WAKE_CLOCK, WAKE_CONFIG = range(8)
+wake_at = array('l', [-1] * 8)  # ticks_ms() of the next expected wake-up per task, -1 for none
+power_checked_ms: int = 0
+power_elapsed_ms: int = 0    # accumulated on every check, ticks_diff() only spans 2^29 ms
+power_slept_ms: int = 0
+power_wakes: int = 0
+power_awake_until_ms: int = -1    # ticks_ms() until which the button keeps the board awake, -1 for none
+
+def expect_wake(task: int, sec) -> None:
+    wake_at[task] = -1 if sec is None else time.ticks_add(time.ticks_ms(), int(sec * 1000))
+
+def sleep_budget_ms() -> int:
+    """ms until the earliest expected wake-up, 0 if a task is due or running"""
+    now = time.ticks_ms()
+    budget = POWER_MAX_SLEEP_MS
+    for due in wake_at:
+        if due >= 0:
+            budget = min(budget, time.ticks_diff(due, now))
+    return max(0, budget)
+
+def can_light_sleep() -> bool:
+    return (config['options']['settings']['power_save'] and not wifi_setup_mode and not wlan.active()
+            and http_connections == 0 and http_streams == 0 and not valve_lock.locked() and power_awake_until_ms < 0)
+
+def power_duty_cycle() -> float:
+    """Estimated fraction of the time awake since manage_power() started"""
+    elapsed_ms = power_elapsed_ms + time.ticks_diff(time.ticks_ms(), power_checked_ms)
+    return round(1 - power_slept_ms / elapsed_ms, 4) if power_checked_ms and elapsed_ms > 0 else 1.0
+
+def scale_cpu(busy: bool) -> None:
+    if config['options']['settings']['power_save']:
+        freq(CPU_BOOST_HZ if busy else CPU_IDLE_HZ)
+
+def set_wifi_power_mode() -> None:
+    try:
+        wlan.config(pm=wlan.PM_POWERSAVE if config['options']['settings']['power_save'] else wlan.PM_PERFORMANCE)
+    except Exception as e:
+        log(LOG_WARNING, "Error setting the WiFi power mode: {}", e)
+
+async def manage_power():
+    global power_checked_ms
+    global power_elapsed_ms
+    global power_slept_ms
+    global power_wakes
+    global power_awake_until_ms
+
+    power_checked_ms = time.ticks_ms()
+    if button_pin_id >= 0:
+        try:
+            esp32.wake_on_ext0(pin=Pin(button_pin_id, Pin.IN, Pin.PULL_UP), level=esp32.WAKEUP_ALL_LOW)
+        except Exception as e:
+            log(LOG_WARNING, "Error setting the button wake-up: {}", e)
+    while True:
+        now = time.ticks_ms()
+        power_elapsed_ms += time.ticks_diff(now, power_checked_ms)
+        power_checked_ms = now
+        if power_awake_until_ms >= 0 and time.ticks_diff(now, power_awake_until_ms) >= 0:
+            power_awake_until_ms = -1
+        if not can_light_sleep():
+            await asyncio.sleep_ms(POWER_CHECK_MS)
+            continue
+        budget = sleep_budget_ms()
+        if budget < POWER_MIN_SLEEP_MS:
+            await asyncio.sleep_ms(POWER_BUSY_CHECK_MS)
+            continue
+        log(LOG_DEBUG, "light sleep for {}ms", budget)
+        save_clock_snapshot(False)
+        started = time.ticks_ms()
+        lightsleep(budget)
+        power_slept_ms += time.ticks_diff(time.ticks_ms(), started)
+        power_wakes += 1
+        if wake_reason() == EXT0_WAKE:
+            log(LOG_INFO, "woken up by the button, staying awake for {} seconds", POWER_BUTTON_AWAKE_SEC)
+            power_awake_until_ms = time.ticks_add(time.ticks_ms(), POWER_BUTTON_AWAKE_SEC * 1000)
+            asyncio.create_task(connect_wifi())
+        # let the tasks that are due run before the next check
+        await asyncio.sleep_ms(0)
+
+#################
+# Instrumentation
+#################
+# Durations are counted into preallocated histograms: array of a count per LATENCY_BUCKETS_US bucket, the +Inf
+# bucket and the sum in milliseconds. observe() only does small int arithmetic, measuring doesn't allocate.
+# GET /metrics renders them, and the other counters, in the Prometheus text format.
+LATENCY_BUCKETS_US: tuple = (1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000, 1000000, 2000000, 5000000)
+HISTOGRAM_SIZE: int = len(LATENCY_BUCKETS_US) + 2
+HTTP_ROUTES: tuple = (('GET', '/'), ('GET', '/favicon.ico'), ('GET', '/config'), ('POST', '/config'), ('PATCH', '/config'),
+    ('POST', '/file/'), ('GET', '/file/'), ('GET', '/status'), ('GET', '/events'), ('GET', '/history'), ('GET', '/metrics'),
+    ('GET', '/log'), ('POST', '/zone/'), ('GET', '/setup'), ('*', 'other'))
+LOOP_LAG_INTERVAL_MS: int = 2000
+http_request_latency: list = [array('L', [0] * HISTOGRAM_SIZE) for _ in HTTP_ROUTES]
+schedule_tick_latency = array('L', [0] * HISTOGRAM_SIZE)
+schedule_tick_jitter = array('L', [0] * HISTOGRAM_SIZE)
+valve_transition_latency = array('L', [0] * HISTOGRAM_SIZE)
+loop_lag = array('L', [0] * HISTOGRAM_SIZE)
+gc_collections: int = 0
+heap_high_water: int = 0
+heap_last_alloc: int = 0
+
+def observe(histogram, duration_us: int) -> None:
+    i = 0
+    while i < len(LATENCY_BUCKETS_US) and duration_us > LATENCY_BUCKETS_US[i]:
+        i += 1
+    histogram[i] += 1
+    histogram[-1] += (duration_us + 500) // 1000
+
+def route_index(method: str, path: str) -> int:
+    for i in range(len(HTTP_ROUTES) - 1):
+        route_method, route_path = HTTP_ROUTES[i]
+        if method == route_method and (path == route_path or route_path[-1] == '/' and len(route_path) > 1 and path.startswith(route_path)):
+            return i
+    return len(HTTP_ROUTES) - 1
+
+def sample_heap() -> None:
+    global gc_collections
+    global heap_high_water
+    global heap_last_alloc
+
+    # MicroPython doesn't count collections, a drop of the allocated heap means at least one happened
+    allocated = gc.mem_alloc()
+    if allocated < heap_last_alloc:
+        gc_collections += 1
+    heap_last_alloc = allocated
+    heap_high_water = max(heap_high_water, allocated)
+
+async def measure_loop_lag():
+    while True:
+        started = time.ticks_ms()
+        wakes = power_wakes
+        await asyncio.sleep_ms(LOOP_LAG_INTERVAL_MS)
+        # a light sleep isn't lag
+        if wakes == power_wakes:
+            observe(loop_lag, max(0, time.ticks_diff(time.ticks_ms(), started) - LOOP_LAG_INTERVAL_MS) * 1000)
+        sample_heap()
+
+def histogram_lines(name: str, histogram, labels: str = '') -> str:
+    lines = []
+    cumulative = 0
+    for i, bound in enumerate(LATENCY_BUCKETS_US):
+        cumulative += histogram[i]
+        lines.append(f'{name}_bucket{{{labels}le="{bound / 1000000}"}} {cumulative}')
+    cumulative += histogram[-2]
+    lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {cumulative}')
+    series = '{' + labels[:-1] + '}' if labels else ''
+    lines.append(f'{name}_sum{series} {histogram[-1] / 1000}')
+    lines.append(f'{name}_count{series} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+async def stream_metrics(writer) -> None:
+    sample_heap()
+    writer.write('# TYPE rsi_http_request_duration_seconds histogram\n')
+    for i, (method, path) in enumerate(HTTP_ROUTES):
+        if sum(http_request_latency[i][:-1]):
+            writer.write(histogram_lines('rsi_http_request_duration_seconds', http_request_latency[i], f'method="{method}",route="{path}",'))
+            await writer.drain()
+    for name, histogram in (('rsi_schedule_tick_duration_seconds', schedule_tick_latency),
+                            ('rsi_schedule_tick_jitter_seconds', schedule_tick_jitter),
+                            ('rsi_valve_transition_duration_seconds', valve_transition_latency),
+                            ('rsi_event_loop_lag_seconds', loop_lag)):
+        writer.write(f'# TYPE {name} histogram\n' + histogram_lines(name, histogram))
+        await writer.drain()
+    for name, metric_type, value in (
+            ('rsi_boot_first_tick_seconds', 'gauge', None if boot_first_tick_ms is None else boot_first_tick_ms / 1000),
+            ('rsi_power_duty_cycle', 'gauge', power_duty_cycle()),
+            ('rsi_power_wakes_total', 'counter', power_wakes),
+            ('rsi_power_sleep_seconds_total', 'counter', power_slept_ms / 1000),
+            ('rsi_gc_collections_total', 'counter', gc_collections),
+            ('rsi_heap_high_water_bytes', 'gauge', heap_high_water),
+            ('rsi_heap_allocated_bytes', 'gauge', gc.mem_alloc()),
+            ('rsi_heap_free_bytes', 'gauge', gc.mem_free()),
+            ('rsi_http_connections', 'gauge', http_connections),
+            ('rsi_http_streams', 'gauge', http_streams),
+            ('rsi_http_evictions_total', 'counter', http_evictions),
+            ('rsi_valve_status', 'gauge', valve_status),
+            ('rsi_schedule_status', 'gauge', schedule_status),
+            ('rsi_irrigation_factor', 'gauge', irrigation_factor),
+            ('rsi_soil_moisture_milli', 'gauge', get_soil_moisture_milli()),
+            ('rsi_mcu_temperature_celsius', 'gauge', esp32.mcu_temperature()),
+            ('rsi_metrics_uploads_total', 'counter', metrics_uploads),
+            ('rsi_metrics_upload_failures_total', 'counter', metrics_upload_failures),
+            ('rsi_metrics_spooled', 'gauge', metrics_spooled),
+            ('rsi_metrics_dropped_total', 'counter', metrics_dropped)):
+        if value is not None:
+            writer.write(f'# TYPE {name} {metric_type}\n{name} {value}\n')
+    await writer.drain()
+
 #############
 # HTTP server
 #############
+# HTTP/1.1 with persistent connections: up to HTTP_MAX_KEEPALIVE connections are kept open between requests,
+# connections beyond that get 'Connection: close'. The request line and headers must arrive within HTTP_IDLE_TIMEOUT_SEC,
+# a request body at least every HTTP_IDLE_TIMEOUT_SEC.
+# Beyond HTTP_MAX_CONNECTIONS a new connection ends the one waiting the longest for its request (idle, or a slowloris
+# client sending it slowly), it's only refused with 503 when all of them are busy serving requests.
+# Endless streams (/events, /log?follow=1) leave that pool for their own HTTP_MAX_STREAMS, open dashboards mustn't
+# lock out the page and config requests. Beyond HTTP_MAX_STREAMS a new stream is refused with 503: an EventSource
+# stops reconnecting on it and the page polls /status instead. Streams of closed pages end at their next write (at
+# most SSE_KEEPALIVE_SEC later), ending the oldest stream instead would have its page reconnect and end the next one.
+HTTP_MAX_CONNECTIONS: int = 8
+HTTP_MAX_STREAMS: int = 3
+HTTP_MAX_KEEPALIVE: int = 4
+HTTP_MAX_REQUESTS_PER_CONNECTION: int = 100
+HTTP_IDLE_TIMEOUT_SEC: int = 5
+http_connections: int = 0
+http_streams: int = 0
+http_waiting: list = []         # handler tasks waiting for a request, oldest first
+http_evictions: int = 0
+# static files are served from a gzip copy (filename.gz) if the client accepts it, the copy is created on first
+# use when the firmware has deflate compression, otherwise it can be uploaded like any other file
+GZIP_EXTENSIONS: tuple = ('.html', '.js', '.css', '.svg')
+gzip_supported: bool = True
+
+class HttpBody:
+    """Request body framed by Content-Length or Transfer-Encoding: chunked. Every read must get data within
+    HTTP_IDLE_TIMEOUT_SEC, otherwise asyncio.TimeoutError ends the request (and the connection)"""
+    def __init__(self, reader, headers: dict):
+        self.reader = reader
+        self.chunked = 'chunked' in headers.get('transfer-encoding', '')
+        self.remaining = 0 if self.chunked else int(headers.get('content-length', '0'))
+        self.eof = not self.chunked and not self.remaining
+
+    async def _next_chunk(self) -> None:
+        line = await asyncio.wait_for(self.reader.readline(), HTTP_IDLE_TIMEOUT_SEC)
+        if not line:
+            raise OSError('connection closed')
+        self.remaining = int(line.split(b';')[0], 16)
+        if not self.remaining:
+            # skip the trailers
+            while (await asyncio.wait_for(self.reader.readline(), HTTP_IDLE_TIMEOUT_SEC)).strip():
+                pass
+            self.eof = True
+
+    async def readinto(self, buf: memoryview) -> int:
+        if self.eof:
+            return 0
+        if self.chunked and not self.remaining:
+            await self._next_chunk()
+            if self.eof:
+                return 0
+        length = await asyncio.wait_for(self.reader.readinto(buf[:min(len(buf), self.remaining)]), HTTP_IDLE_TIMEOUT_SEC)
+        if not length:
+            raise OSError('connection closed')
+        self.remaining -= length
+        if not self.remaining:
+            if self.chunked:
+                await asyncio.wait_for(self.reader.readline(), HTTP_IDLE_TIMEOUT_SEC)
+            else:
+                self.eof = True
+        return length
+
+    async def read(self) -> bytes:
+        if not self.chunked:
+            data = await asyncio.wait_for(self.reader.readexactly(self.remaining), HTTP_IDLE_TIMEOUT_SEC) if self.remaining else b''
+            self.remaining, self.eof = 0, True
+            return data
+        data = bytearray()
+        buf = memoryview(bytearray(512))
+        while length := await self.readinto(buf):
+            data.extend(buf[:length])
+        return bytes(data)
+
+    async def drain(self) -> None:
+        buf = memoryview(bytearray(128))
+        while await self.readinto(buf):
+            pass
+
+# Uploads are written to filename.part and renamed over filename once complete and verified, an interrupted or
+# rejected upload leaves the old file. X-Content-SHA256 has the hex SHA-256 of the whole file. Large files can be
+# sent in pieces with 'Content-Range: bytes start-end/total', 'bytes */total' without a body returns how much of
+# the file was received, to resume after a failure.
+UPLOAD_RESERVE_BYTES: int = 16384   # flash left free after an upload
+
+def free_flash_bytes() -> int:
+    fs = statvfs('/')
+    return fs[0] * fs[4]
+
+def sha256_file(filename: str, buf: memoryview) -> str:
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while length := f.readinto(buf):
+            sha.update(buf[:length])
+    return hexlify(sha.digest()).decode()
+
+async def store_file(body: HttpBody, filename: str, headers: dict) -> tuple:
+    """Stores the request body, or a Content-Range piece of it, as filename. Returns (status code, result)"""
+    start_time = time.ticks_ms()
+    part = filename + '.part'
+    content_range = headers.get('content-range', '')
+    if content_range:
+        unit, _, content_range = content_range.partition(' ')
+        content_range, _, total = content_range.partition('/')
+        total = int(total)
+        try:
+            received = stat(part)[6]
+        except OSError:
+            received = 0
+        if content_range == '*':
+            return 200, {"filepath": filename, "received": received, "total": total}
+        start, _, end = content_range.partition('-')
+        start, end = int(start), int(end)
+        if unit != 'bytes' or not start <= end < total or not body.chunked and body.remaining != end - start + 1:
+            raise ValueError(f"invalid Content-Range: {headers['content-range']}")
+        if start != received:
+            return 416, {"filepath": filename, "received": received, "total": total}
+    else:
+        start, total = 0, None if body.chunked else body.remaining
+    if not start:
+        try:
+            remove(part)
+        except OSError:
+            pass
+    # a chunked body of unknown length is checked as it's written, the free space is only read again (statvfs walks
+    # the file system) once the bytes written would have used it up
+    free = free_flash_bytes()
+    size = total - start if total is not None else 0
+    if size + UPLOAD_RESERVE_BYTES > free:
+        return 507, {"error": f"{size} bytes don't fit, {free} bytes free"}
 
-async def store_file(reader, length: int, filename: str) -> None:
     try:
-        start_time = time.ticks_ms()
-        buf = memoryview(bytearray(1024))
-        with open('upload.tmp', 'wb') as f:
-            while length:
-                chunk_length = await reader.readinto(buf)
-                f.write(buf[:chunk_length])
-                length -= chunk_length
-        rename('upload.tmp', filename)
-        print(f'stored {filename} (stat={stat(filename)}) in {time.ticks_ms() - start_time}ms')
+        # a piece that starts the file is hashed on the way, resumed files are read back once complete
+        sha = hashlib.sha256() if not start else None
+        buf = memoryview(bytearray(config['options']['settings']['upload_buffer_bytes']))
+        received = start
+        with open(part, 'ab' if start else 'wb') as f:
+            while True:
+                # fill the buffer, the flash is written in large blocks
+                filled = 0
+                while filled < len(buf) and (length := await body.readinto(buf[filled:])):
+                    filled += length
+                if not filled:
+                    break
+                if total is None and filled + UPLOAD_RESERVE_BYTES > free:
+                    free = free_flash_bytes()
+                    if filled + UPLOAD_RESERVE_BYTES > free:
+                        break
+                f.write(buf[:filled])
+                free -= filled
+                if sha:
+                    sha.update(buf[:filled])
+                received += filled
+        if total is None and filled:
+            remove(part)
+            return 507, {"error": f"{received + filled}+ bytes don't fit, {free} bytes free"}
+        if total is not None and received < total:
+            return 200, {"filepath": filename, "received": received, "total": total}
+
+        digest = hexlify(sha.digest()).decode() if sha else sha256_file(part, buf)
+        expected = headers.get('x-content-sha256', '').lower()
+        if expected and expected != digest:
+            remove(part)
+            raise ValueError(f"SHA-256 mismatch, received {digest}")
+        rename(part, filename)
+        try:
+            # the gzip copy is stale, it is recreated on the next request
+            remove(filename + '.gz')
+        except OSError:
+            pass
+        log(LOG_INFO, "stored {} ({} bytes, sha256={}) in {}ms", filename, received, digest, time.ticks_ms() - start_time)
+        return 200, {"filepath": filename, "received": received, "total": received, "sha256": digest}
     except Exception as e:
-        print(f"Error storing [{filename}]: {e}")
+        log(LOG_ERROR, "Error storing [{}]: {}", filename, e)
         raise
 
+def can_compress() -> bool:
+    """False if the firmware has no deflate module, or one built without compression support"""
+    try:
+        import deflate
+        gz = deflate.DeflateIO(BytesIO(), deflate.GZIP)
+        gz.write(b'rsi')
+        gz.close()
+        return True
+    except Exception:
+        return False
+
+def compress_file(filename: str) -> bool:
+    """Stores a gzip copy of filename as filename.gz, returns False if it couldn't be compressed"""
+    global gzip_supported
+    try:
+        import deflate
+        start_time = time.ticks_ms()
+        buf = memoryview(bytearray(512))
+        with open(filename, 'rb') as src, open('gzip.tmp', 'wb') as dst:
+            gz = deflate.DeflateIO(dst, deflate.GZIP, 9)
+            while length := src.readinto(buf):
+                gz.write(buf[:length])
+            gz.close()
+        rename('gzip.tmp', filename + '.gz')
+        log(LOG_INFO, "compressed {} (stat={}) in {}ms", filename, stat(filename + '.gz'), time.ticks_ms() - start_time)
+        return True
+    except Exception as e:
+        # a one-off error (e.g. a full flash) is tried again on the next request
+        gzip_supported = can_compress()
+        log(LOG_WARNING, "Error compressing [{}]: {}, serving uncompressed{}", filename, e,
+            '' if gzip_supported else ' from now on')
+        return False
+    finally:
+        try:
+            remove('gzip.tmp')
+        except OSError:
+            pass
+
+def resolve_static_file(filename: str, accept_encoding: str) -> tuple:
+    """Returns (filename to send, file stat, gzipped), preferring the .gz copy when the client accepts it"""
+    if 'gzip' in accept_encoding and not filename.endswith('.gz'):
+        try:
+            return filename + '.gz', stat(filename + '.gz'), True
+        except OSError:
+            if gzip_supported and filename.endswith(GZIP_EXTENSIONS) and compress_file(filename):
+                return filename + '.gz', stat(filename + '.gz'), True
+    return filename, stat(filename), False
+
 async def serve_file(filename: str, writer) -> None:
     try:
         start_time = time.ticks_ms()
         buf = memoryview(bytearray(1024))
-        with open(filename, 'r') as f:
+        with open(filename, 'rb') as f:
             while length := f.readinto(buf):
                 writer.write(buf[:length])
-        print(f'served {time.ticks_ms() - start_time}ms')
+                await writer.drain()
+        log(LOG_DEBUG, "served {} in {}ms", filename, time.ticks_ms() - start_time)
     except Exception as e:
-        print(f"Error serving [{filename}]: {e}")
+        log(LOG_ERROR, "Error serving [{}]: {}", filename, e)
         raise
 
+async def read_http_head(reader) -> tuple:
+    """Returns (request line, headers), (None, None) if the client closed the connection"""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None, None
+    return request_line, await read_http_headers(reader)
+
 async def read_http_headers(reader) -> dict:
     headers = {}
     while True:
         line = await reader.readline()
-        if line == b'\r\n':
+        if not line:
+            raise OSError('connection closed')
+        if line in (b'\r\n', b'\n'):
             break
-        name, value = line.decode().strip().split(': ')
-        headers[name.lower()] = value
+        name, _, value = line.decode().partition(':')
+        headers[name.strip().lower()] = value.strip()
     return headers
 
 def get_status_message(status_code):
     status_messages = {
         200: "OK",
+        304: "Not Modified",
         400: "Bad Request",
         404: "Not Found",
-        500: "Server Error"
+        411: "Length Required",
+        409: "Conflict",
+        416: "Range Not Satisfiable",
+        500: "Server Error",
+        503: "Service Unavailable",
+        507: "Insufficient Storage",
     }
     return status_messages.get(status_code, "Unknown")
 
+def write_http_head(writer, status_code: int, content_type: str, content_length: int, keep_alive: bool, extra_headers: str = '') -> None:
+    """content_length=None for responses delimited by closing the connection"""
+    length_header = f'Content-Length: {content_length}\r\n' if content_length is not None else ''
+    writer.write(f'HTTP/1.1 {status_code} {get_status_message(status_code)}\r\nContent-Type: {content_type}\r\n{length_header}Connection: {"keep-alive" if keep_alive else "close"}\r\n{extra_headers}\r\n')
+
 ################
 # handle_request
 ################
 async def handle_request(reader, writer):
+    global http_connections
+    global http_evictions
+
+    try:
+        if http_connections >= HTTP_MAX_CONNECTIONS:
+            if not http_waiting:
+                write_http_head(writer, 503, 'text/plain', 0, False)
+                await writer.drain()
+                return
+            # the longest waiting connection is idle or slow, it releases its slot once the cancellation is delivered
+            http_waiting.pop(0).cancel()
+            http_evictions += 1
+        http_connections += 1
+        if http_connections == 1:
+            scale_cpu(True)
+        try:
+            for _ in range(HTTP_MAX_REQUESTS_PER_CONNECTION):
+                if not await handle_http_request(reader, writer, http_connections <= HTTP_MAX_KEEPALIVE):
+                    break
+        finally:
+            http_connections -= 1
+            if http_connections == 0:
+                scale_cpu(False)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        # idle, or ended to make room for another connection
+        pass
+    except Exception as e:
+        log(LOG_ERROR, "Error handling connection: {}", e)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+async def run_endless_stream(stream) -> None:
+    """Runs stream out of the connection pool, it's counted in http_streams instead"""
+    global http_connections
+    global http_streams
+
+    http_streams += 1
+    http_connections -= 1
+    if http_connections == 0:
+        scale_cpu(False)
+    try:
+        await stream
+    finally:
+        http_streams -= 1
+        # handle_request() releases the connection when the stream ends
+        http_connections += 1
+
+async def handle_http_request(reader, writer, keep_alive: bool) -> bool:
+    """Serves a single request, returns True if the connection should be kept open for the next one"""
     content_type = 'application/json'
     status_code = 200
     filename = None
+    stream = None   # coroutine writing a response of unknown length, the connection is closed after it
+    endless = False # the stream lasts as long as the client listens
+    route = len(HTTP_ROUTES) - 1
+
+    # until the request line and the headers are in, the connection may be ended to make room for a new one
+    task = asyncio.current_task()
+    http_waiting.append(task)
+    try:
+        request_line, headers = await asyncio.wait_for(read_http_head(reader), HTTP_IDLE_TIMEOUT_SEC)
+    finally:
+        if task in http_waiting:
+            http_waiting.remove(task)
+    if request_line is None:
+        return False
+    request_started = time.ticks_us()
 
     try:
-        method, path, _ = (await reader.readline()).decode().lstrip().split(' ')
+        method, path, version = request_line.decode().strip().split(' ')
         path, query_params = path.split('?') if '?' in path else (path, None)
         query_params = dict([param.replace('+', ' ').split('=') for param in query_params.split('&')]) if query_params else {}
+        route = route_index(method, path)
 
-        headers = await read_http_headers(reader)
-        content_length = int(headers.get('content-length', '0'))
+        request_body = HttpBody(reader, headers)
+        connection = headers.get('connection', '').lower()
+        keep_alive = keep_alive and (connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close')
 
-        print(f"@{time.time()} Request: {method:4} {path:14} query_params={query_params}, (content_length={content_length})")  #     headers={headers}")
+        log(LOG_DEBUG, "Request: {:4} {:14} query_params={}, (content_length={}, chunked={})", method, path, query_params, request_body.remaining, request_body.chunked)  #     headers={headers}")
 
         if method == 'GET' and path == '/':
             filename = 'setup.html' if wifi_setup_mode else 'index.html'
@@ -396,49 +2330,105 @@ async def handle_request(reader, writer):
             response = '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 100"><path d="M50 5 C30 5 5 35 5 60 C5 85 25 95 50 95 C75 95 95 85 95 60 C95 35 70 5 50 5Z" fill="#4FC3F7" stroke="#29B6F6" stroke-width="2"/><ellipse cx="30" cy="35" rx="10" ry="15" fill="#81D4FA" transform="rotate(-35 30 35)"/></svg>'
         elif method == 'GET' and path == '/config':
             # curl example: curl http://[ESP32_IP]/config
-            response = ujson.dumps(config)
+            response = ujson.dumps(get_config())
         elif method == 'POST' and path == '/config':
-            body = ujson.loads((await reader.read(content_length)).decode()) if content_length > 0 else None
             # restore backup: jq . irrigation-config.json | curl -H "Content-Type: application/json" -X POST --data-binary @- http://192.168.68.ESP/config
-            print(f"applying new config = {body}")
-            apply_config(body)
-            response = ujson.dumps(config)
-            save_as_json('config.json', config)
+            try:
+                response = ujson.dumps(await upload_config(request_body))
+            except (ValueError, KeyError, TypeError, IndexError) as e:
+                log(LOG_WARNING, "rejected config: {}", e)
+                response = ujson.dumps({"error": f"invalid config: {e}"})
+                status_code = 400
+        elif method == 'PATCH' and path == '/config':
+            # curl -X PATCH --data '[{"op": "replace", "path": "/schedules/0/enabled", "value": false}]' http://192.168.68.ESP/config
+            try:
+                if request_body.remaining > CONFIG_MAX_BYTES:
+                    raise ValueError(f'larger than {CONFIG_MAX_BYTES} bytes')
+                operations = await JsonStreamReader(request_body, CONFIG_MAX_BYTES).value()
+                patch_config(operations)
+                response = ujson.dumps({"applied": len(operations)})
+            except (ValueError, KeyError, TypeError, IndexError) as e:
+                log(LOG_WARNING, "rejected config patch: {}", e)
+                response = ujson.dumps({"error": f"invalid patch: {e}"})
+                status_code = 400
         elif method == 'POST' and path.startswith('/file/'):
-            # curl -X POST --data-binary @main.py http://192.168.68.114/file/main.py\?reboot\=1
-            print(f"Updating {path[6:]}")
-            await store_file(reader, content_length, path[6:])
-            if '1' == query_params.get('reboot', '0'):
-                print("Rebooting...")
-                reset()
-            response = ujson.dumps({
-                "method": method,
-                "filepath": path[6:],
-                "stat": ujson.dumps(stat(path[6:])),
-            })
+            # curl -X POST --data-binary @main.py -H "X-Content-SHA256: $(sha256sum main.py | cut -c-64)" http://192.168.68.114/file/main.py\?reboot\=1
+            log(LOG_INFO, "Updating {}", path[6:])
+            try:
+                status_code, result = await store_file(request_body, path[6:], headers)
+            except ValueError as e:
+                status_code, result = 400, {"error": f"rejected upload: {e}"}
+            if status_code == 200 and 'sha256' in result:
+                if '1' == query_params.get('reboot', '0'):
+                    if config_save_pending:
+                        save_config()
+                    log(LOG_WARNING, "Rebooting...")
+                    reset()
+                result['method'] = method
+                result['stat'] = ujson.dumps(stat(path[6:]))
+            response = ujson.dumps(result)
         elif method == 'GET' and path.startswith('/file/'):
             filename = path[6:]
             content_type = 'text/html'
+        elif method == 'POST' and path.startswith('/zone/'):
+            # curl -X POST "http://[ESP32_IP]/zone/0/run?duration=600", curl -X POST http://[ESP32_IP]/zone/0/stop
+            try:
+                zone_id, action = path[6:].split('/')
+                zone_id = int(zone_id)
+                if not 0 <= zone_id < len(config['zones']) or action not in ('run', 'stop'):
+                    status_code = 404
+                elif action == 'run':
+                    duration_sec = int(query_params.get('duration', 0))
+                    if not 0 < duration_sec <= MANUAL_MAX_SEC:
+                        raise ValueError(f'duration of 1..{MANUAL_MAX_SEC} seconds expected')
+                    if manual_run_fits(zone_id):
+                        run_zone(zone_id, duration_sec)
+                    else:
+                        status_code = 409
+                else:
+                    stop_zone(zone_id)
+                if status_code == 404:
+                    response = ujson.dumps({"error": f"not found: {path}"})
+                elif status_code == 409:
+                    response = ujson.dumps({"error": f"zone {zone_id} exceeds max_concurrent_valves/max_concurrent_weight, stop a zone first"})
+                else:
+                    response = ujson.dumps({"overrides": zone_overrides()})
+            except ValueError as e:
+                response = ujson.dumps({"error": f"invalid zone request: {e}"})
+                status_code = 400
         elif method == 'GET' and path == '/status':
             # tt = time.gmtime()
-            soil_moisture_raw = read_soil_moisture_raw()
-            soil_moisture_milli = get_soil_moisture_milli(soil_moisture_raw)
-            response = ujson.dumps({
-                "local_timestamp": get_local_timestamp(),
-                "soil_moisture_milli": soil_moisture_milli,
-                "soil_moisture_raw": soil_moisture_raw,
-                "gc.mem_alloc": gc.mem_alloc(),
-                "gc.mem_free": gc.mem_free(),
-                "valve_status": f"{valve_status:08b}",
-                "schedule_status": f"{schedule_status:08b}",
-                "mcu_temperature": esp32.mcu_temperature(),
-                "irrigation_factor": irrigation_factor,
-                "hostname": config['options']['wifi']['hostname'],
-            })
+            response = ujson.dumps(get_status())
+        elif method == 'GET' and path == '/events':
+            # curl -N http://[ESP32_IP]/events
+            content_type = 'text/event-stream'
+            stream = stream_status_events(writer)
+            endless = True
+        elif method == 'GET' and path == '/history':
+            # curl "http://[ESP32_IP]/history?from=1700000000&to=1700086400&step=3600"
+            try:
+                end = int(query_params.get('to', time.time() + micropython_to_timestamp))
+                start = int(query_params.get('from', end - 86400))
+                step = int(query_params.get('step', max(1, (end - start) // HISTORY_MAX_POINTS)))
+                if start >= end or step <= 0:
+                    raise ValueError('from < to and step > 0 expected')
+                stream = stream_history(writer, start, end, step)
+            except ValueError as e:
+                response = ujson.dumps({"error": f"invalid range: {e}"})
+                status_code = 400
+        elif method == 'GET' and path == '/metrics':
+            # curl http://[ESP32_IP]/metrics
+            content_type = 'text/plain; version=0.0.4'
+            stream = stream_metrics(writer)
+        elif method == 'GET' and path == '/log':
+            # curl -N http://[ESP32_IP]/log?follow=1
+            content_type = 'text/plain'
+            endless = query_params.get('follow', '0') == '1'
+            stream = stream_log(writer, endless)
         elif wifi_setup_mode and method == 'GET' and path == '/setup':
-                print(f"Setup: query_params={query_params}")
+                log(LOG_INFO, "Setup: query_params={}", query_params)
                 save_as_json('config.json', {"options": { "wifi": query_params }})
-                print("Restarting...")
+                log(LOG_WARNING, "Restarting...")
                 await asyncio.sleep(0.1)
                 if heartbeat_pin_id > 0:
                     Pin(heartbeat_pin_id, Pin.IN)
@@ -448,35 +2438,59 @@ async def handle_request(reader, writer):
             response = f"Resource not found: method={method} path={path}"
             status_code = 404
 
+        if not request_body.eof:
+            # the handler didn't consume the body, don't try to find the next request in it
+            keep_alive = False
+
+    except asyncio.TimeoutError:
+        # the client stopped sending the body, the connection slot is freed
+        log(LOG_WARNING, "request body timed out: {}", request_line)
+        return False
     except Exception as e:
-        print(f"Error handling request: {e}")
-        writer.write(f'HTTP/1.0 500 {get_status_message(500)}\r\n')
+        log(LOG_ERROR, "Error handling request: {}", e)
+        write_http_head(writer, 500, 'text/plain', 0, False)
         await writer.drain()
-        writer.close()
-        await writer.wait_closed()
-        raise
+        observe(http_request_latency[route], time.ticks_diff(time.ticks_us(), request_started))
+        return False
 
-    writer.write(f'HTTP/1.0 {status_code} {get_status_message(status_code)}\r\nContent-type: {content_type}\r\n\r\n')
+    if stream and endless and http_streams >= HTTP_MAX_STREAMS:
+        stream.close()
+        log(LOG_WARNING, "{} streams open, refusing {}", http_streams, path)
+        response = ujson.dumps({"error": f"more than {HTTP_MAX_STREAMS} streams, poll instead"})
+        write_http_head(writer, 503, 'application/json', len(response), False)
+        writer.write(response)
+        await writer.drain()
+        observe(http_request_latency[route], time.ticks_diff(time.ticks_us(), request_started))
+        return False
+    if stream:
+        write_http_head(writer, status_code, content_type, None, False, 'Cache-Control: no-cache\r\n')
+        if endless:
+            # timed until the head is sent
+            observe(http_request_latency[route], time.ticks_diff(time.ticks_us(), request_started))
+            await run_endless_stream(stream)
+        else:
+            await stream
+            observe(http_request_latency[route], time.ticks_diff(time.ticks_us(), request_started))
+        return False
     if filename:
-        await serve_file(filename, writer)
+        filename, file_stat, gzipped = resolve_static_file(filename, headers.get('accept-encoding', ''))
+        # the ETag changes whenever the file is replaced, clients revalidate on every load (no-cache)
+        etag = f'"{file_stat[6]:x}-{file_stat[8]:x}"'
+        extra_headers = f'ETag: {etag}\r\nCache-Control: no-cache\r\nVary: Accept-Encoding\r\n'
+        if gzipped:
+            extra_headers += 'Content-Encoding: gzip\r\n'
+        if etag in headers.get('if-none-match', ''):
+            write_http_head(writer, 304, content_type, 0, keep_alive, extra_headers)
+        else:
+            write_http_head(writer, status_code, content_type, file_stat[6], keep_alive, extra_headers)
+            await serve_file(filename, writer)
     else:
+        response = response.encode()
+        write_http_head(writer, status_code, content_type, len(response), keep_alive)
         writer.write(response)
     await writer.drain()
-    writer.close()
-    await writer.wait_closed()
-
-async def send_metrics():
-    global irrigation_factor
-
-    while True:
-        try:
-            # TODO: add micropython.mem_info()
-            if 'thingsspeak_apikey' in config['options']['monitoring']:
-                requests.get(f"http://api.thingspeak.com/update?api_key={config['options']['monitoring']['thingsspeak_apikey']}&field1={get_soil_moisture_milli()}&field2={gc.mem_alloc()}&field3={valve_status}&field4={irrigation_factor}&field5={esp32.mcu_temperature()}", timeout=10).close()
-        except Exception as e:
-            print(f"Error sending metrics: {e}")
-        finally:
-            await asyncio.sleep(config['options']['monitoring']['send_interval_sec'])
+    observe(http_request_latency[route], time.ticks_diff(time.ticks_us(), request_started))
+    return keep_alive
 
 async def wait_for_wifi_setup(button_pin_id: int, wait_time: int) -> None:
     global wifi_setup_mode
@@ -487,21 +2501,21 @@ async def wait_for_wifi_setup(button_pin_id: int, wait_time: int) -> None:
             wifi_setup_mode = True
             break
     if wifi_setup_mode:
+        # the server, already running, serves setup.html from now on
         if heartbeat_pin_id >= 0:
             PWM(Pin(heartbeat_pin_id), freq=5, duty_u16=32768)
         ap = network.WLAN(network.AP_IF)
         ap.active(True)
         ap.config(essid='irrigation-esp32')
-        server = await asyncio.start_server(handle_request, "0.0.0.0", 80)
-        print('Server listening on port 80')
-        await server.wait_closed()
+        log(LOG_INFO, "wifi setup mode, access point irrigation-esp32")
 
 async def main():
     global valve_status
     global heartbeat_pin_id
+    global button_pin_id
 
     if sys.maxsize>>30 == 0:
-        print(">>> We have less than 31 bits :(")
+        log(LOG_WARNING, ">>> We have less than 31 bits :(")
 
     BoardBootstrap = namedtuple('BoardBootstrap', ['name', 'button_pin_id', 'heartbeat_pin_id'])
     for bootstrap in [
@@ -511,32 +2525,32 @@ async def main():
     ]:
         if bootstrap.name in sys.implementation._machine:
             break
-    print(f"Starting irrigation-esp32 on [{sys.implementation._machine}] detected as {bootstrap}")
+    log(LOG_INFO, "Starting irrigation-esp32 on [{}] detected as {}", sys.implementation._machine, bootstrap)
     heartbeat_pin_id = bootstrap.heartbeat_pin_id
+    button_pin_id = bootstrap.button_pin_id
 
-    freq(80_000_000)
-
-    if bootstrap.button_pin_id >= 0:
-        await wait_for_wifi_setup(bootstrap.button_pin_id, 1)
+    freq(CPU_IDLE_HZ)
 
-    apply_config(load_from_json('config.json') or {})
+    # nothing waits for the network: the scheduler runs on the restored clock and the server starts right away,
+    # the setup button, then WiFi and NTP are handled in the background
+    restore_clock()
+    load_config()
 
     # set valve_status = 0b1111...1 so that the first apply_valves will turn off all valves
     valve_status = (1<<len(config['zones']))-1
     await apply_valves(0)
 
-    await connect_wifi()
-    await sync_ntp()
-    # if not wlan.isconnected():
-        # we can go to wifi setup mode
-        # print("WiFi connection failed on startup, starting irrigation scheduler, will retry reconnecting in background")
-    asyncio.create_task(keep_wifi_connected())
-    asyncio.create_task(periodic_ntp_sync())
-    asyncio.create_task(send_metrics())
     asyncio.create_task(schedule_irrigation())
-
-    server = await asyncio.start_server(handle_request, "0.0.0.0", 80)
-    print('Server listening on port 80')
+    server = await asyncio.start_server(handle_request, "0.0.0.0", HTTP_PORT)
+    log(LOG_INFO, "Server listening on port {}", HTTP_PORT)
+
+    asyncio.create_task(start_network(button_pin_id))
+    asyncio.create_task(snapshot_clock())
+    asyncio.create_task(sample_soil_moisture())
+    asyncio.create_task(persist_config())
+    asyncio.create_task(record_history())
+    asyncio.create_task(measure_loop_lag())
+    asyncio.create_task(manage_power())
     await server.wait_closed()
 
 if __name__ == "__main__":